@@ -2,35 +2,207 @@
 # Important: use Chat class defined in the bottom of this file
 ###############################################################
 
+import asyncio
+import atexit
+import bisect
+import codecs
+import hashlib
+import heapq
+import json
+import math
 import os
 import pickle
+import random
+import re
+import signal
+import sqlite3
+import threading
 import time
 
+from collections import OrderedDict, deque
+from contextlib import AsyncExitStack
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
-from typing import List, Dict
-
-import boto3
 
 class Model():
-    def __init__(self, key, model_id, in_price, out_price, in_length, out_length):
+    def __init__(self, key, model_id, in_price, out_price, in_length, out_length, cache_read_price=None, cache_write_price=None):
         self.key = key
         self.model_id = model_id
         self.in_price = in_price
         self.out_price = out_price
         self.in_length = in_length
         self.out_length = out_length
+        # prices of prompt cache reads and writes, None when the model has no prompt caching
+        self.cache_read_price = cache_read_price
+        self.cache_write_price = cache_write_price
+
+class ModelsFailed(Exception):
+
+    """
+    Raised when no model answered, attempts tells what each model did
+    """
+
+    def __init__(self, attempts):
+        super().__init__("All models failed to process the request")
+        self.attempts = attempts
+
+    def throttled(self):
+        return any(["Throttling" in a.get("error", "") or "TooManyRequests" in a.get("error", "") for a in self.attempts])
+
+class ResponseCache():
+
+    """
+    Answers keyed by a hash of the model id and the context texts.
+    An in-memory LRU of max_size entries in front of an optional SQLite file,
+    entries older than ttl seconds are misses.
+    """
+
+    def __init__(self, max_size=256, ttl=3600, path=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+
+        self._conn = None
+        if path:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, created REAL NOT NULL, answer TEXT NOT NULL)")
+            self._conn.commit()
+
+    @staticmethod
+    def context_hash(context):
+        digest = hashlib.sha256()
+        for c in context:
+            # a blob is already a hash of its text
+            text = c.blob.encode("utf-8") if c.blob else c.text.encode("utf-8")
+            # the length keeps ["ab", "c"] and ["a", "bc"] apart
+            digest.update(len(text).to_bytes(8, "big"))
+            digest.update(text)
+        return digest.hexdigest()
+
+    @staticmethod
+    def key(model_id, context_hash):
+        return hashlib.sha256(f"{model_id}:{context_hash}".encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """
+        Returns the cached answer of key or None
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and now - entry[0] <= self.ttl:
+                self._memory.move_to_end(key)
+                self._hits += 1
+                return dict(entry[1])
+            if entry is not None:
+                del self._memory[key]
+
+            if self._conn is not None:
+                row = self._conn.execute("SELECT created, answer FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None and now - row[0] <= self.ttl:
+                    answer = json.loads(row[1])
+                    self._put_memory(key, row[0], answer)
+                    self._hits += 1
+                    self._disk_hits += 1
+                    return dict(answer)
+
+            self._misses += 1
+            return None
+
+    def put(self, key, answer):
+        now = time.time()
+        with self._lock:
+            self._put_memory(key, now, answer)
+            if self._conn is not None:
+                with self._conn:
+                    self._conn.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+                    self._conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", (key, now, json.dumps(answer)))
+
+    def _put_memory(self, key, created, answer):
+        self._memory[key] = (created, answer)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_size:
+            self._memory.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            requests = self._hits + self._misses
+            return {
+                "hits": self._hits,
+                "disk_hits": self._disk_hits,
+                "misses": self._misses,
+                "hit_rate": self._hits / requests if requests else 0.0,
+                "size": len(self._memory)}
+
+class ModelHealth():
+
+    """
+    Rolling latency and error stats per model over the last window calls,
+    and a circuit breaker: after max_failures failures in a row a model is skipped
+    for cooldown seconds, then it is tried again and one more failure skips it again.
+    """
+
+    def __init__(self, window=50, max_failures=3, cooldown=60):
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._window = window
+        self._calls = {}
+        self._failures = {}
+        self._opened = {}
+
+    def record(self, key, ok, latency):
+        with self._lock:
+            self._calls.setdefault(key, deque(maxlen=self._window)).append((ok, latency))
+            if ok:
+                self._failures[key] = 0
+                self._opened.pop(key, None)
+            else:
+                self._failures[key] = self._failures.get(key, 0) + 1
+                if self._failures[key] >= self.max_failures:
+                    self._opened[key] = time.time()
+
+    def available(self, key):
+        opened = self._opened.get(key)
+        return opened is None or time.time() - opened >= self.cooldown
+
+    def stats(self, key):
+        with self._lock:
+            calls = list(self._calls.get(key, []))
+            opened = self._opened.get(key)
+
+        if opened is None:
+            state = "closed"
+        elif time.time() - opened < self.cooldown:
+            state = "open"
+        else:
+            state = "half-open"
+
+        latencies = sorted([latency for ok, latency in calls if ok])
+        return {
+            "state": state,
+            "calls": len(calls),
+            "error_rate": len([ok for ok, _ in calls if not ok]) / len(calls) if calls else 0.0,
+            "avg_latency": sum(latencies) / len(latencies) if latencies else None,
+            "p90_latency": latencies[int(len(latencies) * 0.9)] if latencies else None}
 
 class Bedrock():
 
-    def __init__(self):
+    def __init__(self, hedge_after=None, cache=None, max_connections=None, max_concurrency=None, health=None):
 
         # set up the models
         self.models = [
             Model(key="meta", model_id="meta.llama3-70b-instruct-v1:0", in_price=0.00072, out_price=0.00072, in_length=128000, out_length=2048),
             Model(key="mistral", model_id="mistral.mistral-large-2402-v1:0", in_price=0.004, out_price=0.012, in_length=32768, out_length=8192),
-            Model(key="amazon", model_id="amazon.nova-pro-v1:0", in_price=0.0008, out_price=0.0032, in_length=300000, out_length=5000),
+            Model(key="amazon", model_id="amazon.nova-pro-v1:0", in_price=0.0008, out_price=0.0032, in_length=300000, out_length=5000, cache_read_price=0.0002, cache_write_price=0.0008),
             Model(key="cohere", model_id="cohere.command-r-plus-v1:0", in_price=0.003, out_price=0.015, in_length=128000, out_length=4096),
-            Model(key="anthropic", model_id="anthropic.claude-3-7-sonnet-20250219-v1:0", in_price=0.003, out_price=0.015, in_length=200000, out_length=128000),#
+            Model(key="anthropic", model_id="anthropic.claude-3-7-sonnet-20250219-v1:0", in_price=0.003, out_price=0.015, in_length=200000, out_length=128000, cache_read_price=0.0003, cache_write_price=0.00375),#
             Model(key="ai21", model_id="ai21.jamba-1-5-large-v1:0", in_price=0.002, out_price=0.008, in_length=256000, out_length=256000)
         ]
         # find the maximum context length
@@ -38,15 +210,66 @@ class Bedrock():
         # create a set of models for quick access
         self.model_names = {model.key for model in self.models}
 
-        # set up the bedrock client
-        self._client = boto3.client("bedrock-runtime", region_name=os.environ.get('AWS_REGION'))
+        # size of the HTTP connection pool and how many async calls can be in flight at once
+        self.max_connections = max_connections or int(os.environ.get('BEDROCK_MAX_CONNECTIONS', 50))
+        self.max_concurrency = max_concurrency or int(os.environ.get('BEDROCK_MAX_CONCURRENCY', 16))
+        # a shorter prefix is not worth a cache point, models need about 1024 tokens to cache
+        self.prompt_cache_min_length = int(os.environ.get('BEDROCK_PROMPT_CACHE_MIN_LENGTH', 4096))
+        # BEDROCK_ENDPOINT_URL points the clients to a stand-in such as bedrock_stub.py
+        self._endpoint_url = os.environ.get('BEDROCK_ENDPOINT_URL')
 
-    def call(self, models, context):
+        # the bedrock client is created on first use, importing boto3 takes a while
+        self._sync_client = None
+        self._client_lock = threading.Lock()
+        # async clients are per event loop, created on the first call_async
+        self._async_clients = {}
+        # the tasks that close them when their loop ends, a loop keeps only weak references to tasks
+        self._async_closers = set()
 
-        start = time.time()
+        # seconds to wait for a model before also calling the next one, None calls the models one by one
+        if hedge_after is None and os.environ.get('BEDROCK_HEDGE_AFTER'):
+            hedge_after = float(os.environ['BEDROCK_HEDGE_AFTER'])
+        self.hedge_after = hedge_after
+        # calls from many chats share these threads, sized like the async limit
+        self._executor = ThreadPoolExecutor(max_workers=max(len(self.models), self.max_concurrency))
+
+        # answers to identical requests, BEDROCK_CACHE_SIZE=0 turns it off
+        if cache is None:
+            cache_size = int(os.environ.get('BEDROCK_CACHE_SIZE', 256))
+            if cache_size > 0:
+                cache = ResponseCache(
+                    max_size=cache_size,
+                    ttl=float(os.environ.get('BEDROCK_CACHE_TTL', 3600)),
+                    path=os.environ.get('BEDROCK_CACHE_PATH'))
+        self.cache = cache or None
+
+        # models that failed repeatedly are skipped for a while
+        self.health = health or ModelHealth(
+            max_failures=int(os.environ.get('BEDROCK_BREAKER_FAILURES', 3)),
+            cooldown=float(os.environ.get('BEDROCK_BREAKER_COOLDOWN', 60)))
 
-        context_text_length = sum([len(c.text) for c in context])
+    @property
+    def _client(self):
+        if self._sync_client is None:
+            with self._client_lock:
+                if self._sync_client is None:
+                    import boto3
+                    from botocore.config import Config
 
+                    self._sync_client = boto3.client(
+                        "bedrock-runtime",
+                        region_name=os.environ.get('AWS_REGION'),
+                        endpoint_url=self._endpoint_url,
+                        config=Config(max_pool_connections=self.max_connections))
+        return self._sync_client
+
+    def _candidates(self, models, context_text_length):
+        """
+        Returns the models that can take the context, in order.
+        If the last model is too short, the longest model is used instead.
+        Models with an open circuit breaker are left out unless no other model is left.
+        """
+        candidates = []
         for i in range(len(models)):
 
             current_model = models[i]
@@ -57,149 +280,1191 @@ class Bedrock():
                 else:
                     continue
 
-            conversation = [
-                    {
-                        "role": "user",
-                        "content": [{"text": c.text} for c in context]
-                    }
-                ]
-            
+            candidates.append(current_model)
+
+        healthy = [m for m in candidates if self.health.available(m.key)]
+        return healthy or candidates
+
+    def _conversation(self, context):
+        """
+        Returns the messages and where to put cache points, before content blocks that change:
+        before the question, whose prefix the next turn reads, and before the previous question,
+        whose prefix the previous turn wrote. Neither is past the parts of files retrieved for this question.
+        """
+        stable = len(context) - 1
+        for i, c in enumerate(context):
+            if c.retrieved:
+                stable = min(stable, i)
+                break
+        cache_points = [stable]
+        # the previous question is the item before the last answer
+        for i in range(len(context) - 2, 0, -1):
+            if context[i].type == "out":
+                if context[i - 1].type == "in" and i - 1 < stable:
+                    cache_points.insert(0, i - 1)
+                break
+        return [
+                {
+                    "role": "user",
+                    "content": [{"text": c.text} for c in context]
+                }
+            ], [p for p in cache_points if p > 0]
+
+    def _messages(self, model, conversation, cache_points):
+        """
+        For models with prompt caching, marks the blocks that stay the same (attached files and earlier turns)
+        with cache points: the prefix up to the previous turn's point is read from the cache
+        and only the blocks after it are written
+        """
+        content = conversation[0]["content"]
+        if model.cache_read_price is None:
+            return conversation
+        # a prefix shorter than the model's minimum is not cached
+        cache_points = [p for p in cache_points if sum([len(c["text"]) for c in content[:p]]) >= self.prompt_cache_min_length]
+        if not cache_points:
+            return conversation
+        marked = []
+        start = 0
+        for p in cache_points:
+            marked += content[start:p] + [{"cachePoint": {"type": "default"}}]
+            start = p
+        return [{"role": "user", "content": marked + content[start:]}]
+
+    def _cached(self, candidates, context):
+        """
+        Returns the context hash and the cached answer of the model that would be called or None.
+        Answers of the fallback models are not used, they are not what the first model would answer.
+        """
+        if self.cache is None:
+            return None, None
+        context_hash = ResponseCache.context_hash(context)
+        answer = self.cache.get(ResponseCache.key(candidates[0].model_id, context_hash))
+        if answer is None:
+            return context_hash, None
+        return context_hash, {
+            "text": answer["text"],
+            "model": candidates[0].model_id,
+            "cost": 0,
+            "time": 0,
+            "attempts": [],
+            "cached": True}
+
+    def _converse(self, model, conversation, cache_points):
+        start = time.time()
+        try:
+            response = self._client.converse(
+                modelId=model.model_id,
+                messages=self._messages(model, conversation, cache_points),
+                inferenceConfig={
+                    "maxTokens": model.out_length,
+                    },
+            )
+            result = self._parse(model, response)
+        except Exception:
+            self.health.record(model.key, False, time.time() - start)
+            raise
+        self.health.record(model.key, True, time.time() - start)
+        return result
+
+    def _cost(self, model, usage):
+        in_tokens = usage["inputTokens"]
+        out_tokens = usage["outputTokens"]
+        cost = in_tokens / 1000.0 * model.in_price + out_tokens / 1000.0 * model.out_price
+        # tokens read from or written to the prompt cache are not in inputTokens
+        cache_read_tokens = usage.get("cacheReadInputTokens", 0)
+        cache_write_tokens = usage.get("cacheWriteInputTokens", 0)
+        if cache_read_tokens or cache_write_tokens:
+            cost += cache_read_tokens / 1000.0 * (model.cache_read_price or model.in_price)
+            cost += cache_write_tokens / 1000.0 * (model.cache_write_price or model.in_price)
+        return cost
+
+    def _parse(self, model, response):
+        cost = self._cost(model, response["usage"])
+        response_text = response["output"]["message"]["content"][0]["text"].strip()
+        return response_text, cost
+
+    def call(self, models, context, context_text_length=None, hedge_after=None):
+
+        """
+        Sends the context to the first model that answers.
+        With hedge_after (seconds), when a model has not answered in time
+        the next model is called in parallel and the first answer wins.
+        Time spent waiting for a free thread does not count toward hedge_after.
+        Every model tried is listed in "attempts" with its status, cost and time.
+        An ignored call is still billed, its cost is set in attempts when it finishes.
+        A cached answer is returned with "cached" set and no cost or time.
+        """
+
+        start = time.time()
+
+        if context_text_length is None:
+            context_text_length = sum([len(c.text) for c in context])
+
+        if hedge_after is None:
+            hedge_after = self.hedge_after
+
+        candidates = self._candidates(models, context_text_length)
+
+        context_hash, answer = self._cached(candidates, context)
+        if answer is not None:
+            return answer
+
+        conversation, cache_points = self._conversation(context)
+        attempts = []
+        pending = {}
+        # when each attempt's call started on a thread, None while it waits for one
+        started = []
+
+        def converse(i, current_model):
+            started[i] = time.time()
+            return self._converse(current_model, conversation, cache_points)
+
+        def attempt_next():
+            current_model = candidates[len(attempts)]
+            attempt = {"model": current_model.model_id, "status": "running", "cost": None, "time": None}
+            attempts.append(attempt)
+            started.append(None)
+            future = self._executor.submit(converse, len(attempts) - 1, current_model)
+            pending[future] = (current_model, attempt, len(attempts) - 1)
+
+        def elapsed(i):
+            return time.time() - started[i] if started[i] is not None else 0.0
+
+        def ignored_done(future, attempt):
+            # the answer is not used but the call is billed
+            if future.cancelled():
+                return
             try:
-                
-                response = self._client.converse(
-                    modelId=current_model.model_id,
-                    messages=conversation,
-                    inferenceConfig={
-                        "maxTokens": current_model.out_length,
-                        },
-                )
-                usage = response["usage"]
-                in_tokens = usage["inputTokens"]
-                out_tokens = usage["outputTokens"]
-                cost = in_tokens / 1000.0 * current_model.in_price + out_tokens / 1000.0 * current_model.out_price
-                response_text = response["output"]["message"]["content"][0]["text"].strip()
+                attempt["cost"] = future.result()[1]
+            except Exception as e:
+                attempt["error"] = str(e)
+
+        if candidates:
+            attempt_next()
+
+        while pending:
+
+            can_hedge = hedge_after is not None and len(attempts) < len(candidates)
+            timeout = None
+            if can_hedge:
+                # counted from when the last call started, not from when it was queued
+                timeout = max(0.0, hedge_after - elapsed(len(attempts) - 1))
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            if not done:
+                if started[-1] is not None and elapsed(len(attempts) - 1) >= hedge_after:
+                    # the running models are slow, call the next one too
+                    attempt_next()
+                continue
+
+            for future in done:
+                current_model, attempt, i = pending.pop(future)
+                attempt["time"] = elapsed(i)
+                try:
+                    response_text, cost = future.result()
+                except Exception as e:
+                    # Log failure and try the next model
+                    print(f"Model {current_model.key} failed at {datetime.now()}: {e}")
+                    attempt["status"] = "failed"
+                    attempt["error"] = str(e)
+                    if len(attempts) < len(candidates):
+                        attempt_next()
+                    continue
+
+                attempt["status"] = "succeeded"
+                attempt["cost"] = cost
+
+                # the other calls can't be stopped once sent, their answers are ignored
+                for other, (_, other_attempt, other_i) in pending.items():
+                    other_attempt["time"] = elapsed(other_i)
+                    if other.cancel():
+                        other_attempt["status"] = "cancelled"
+                        other_attempt["cost"] = 0
+                    else:
+                        other_attempt["status"] = "ignored"
+                        other.add_done_callback(lambda f, a=other_attempt: ignored_done(f, a))
+
+                if self.cache is not None:
+                    self.cache.put(ResponseCache.key(current_model.model_id, context_hash), {"text": response_text})
 
                 return {
                     "text": response_text, 
                     "model": current_model.model_id, 
                     "cost": cost, 
-                    "time": time.time() - start}
+                    "time": time.time() - start,
+                    "attempts": attempts}
+
+        # If all models fail, raise an HTTPException
+        raise ModelsFailed(attempts)
+
+    def call_stream(self, models, context, context_text_length=None):
+
+        """
+        Streams the answer with converse_stream.
+        Yields the text as it is generated and then the same dict as call returns.
+        A model that fails before its first text is skipped for the next one,
+        a failure in the middle of an answer is raised.
+        Closing the generator closes the model's stream, the rest of the answer is not read.
+        """
+
+        start = time.time()
+
+        if context_text_length is None:
+            context_text_length = sum([len(c.text) for c in context])
+
+        candidates = self._candidates(models, context_text_length)
+
+        context_hash, answer = self._cached(candidates, context)
+        if answer is not None:
+            yield answer["text"]
+            yield answer
+            return
+
+        conversation, cache_points = self._conversation(context)
+        attempts = []
+
+        for current_model in candidates:
+
+            attempt = {"model": current_model.model_id, "status": "running", "cost": None, "time": None}
+            attempts.append(attempt)
+            attempt_start = time.time()
+            parts = []
+            usage = None
+
+            try:
+                response = self._client.converse_stream(
+                    modelId=current_model.model_id,
+                    messages=self._messages(current_model, conversation, cache_points),
+                    inferenceConfig={
+                        "maxTokens": current_model.out_length,
+                        },
+                )
+                for event in response["stream"]:
+                    if "contentBlockDelta" in event:
+                        text = event["contentBlockDelta"]["delta"].get("text", "")
+                        if text:
+                            if not parts:
+                                attempt["first_token_time"] = time.time() - attempt_start
+                            parts.append(text)
+                            yield text
+                    elif "metadata" in event:
+                        usage = event["metadata"].get("usage")
+            except GeneratorExit:
+                response["stream"].close()
+                raise
             except Exception as e:
+                attempt["status"] = "failed"
+                attempt["error"] = str(e)
+                attempt["time"] = time.time() - attempt_start
+                self.health.record(current_model.key, False, attempt["time"])
+                if parts:
+                    raise
                 # Log failure and try the next model
                 print(f"Model {current_model.key} failed at {datetime.now()}: {e}")
+                continue
 
-        # If all models fail, raise an HTTPException
-        raise Exception("All models failed to process the request")
+            response_text = "".join(parts).strip()
+            cost = self._cost(current_model, usage) if usage else 0
+
+            attempt["status"] = "succeeded"
+            attempt["cost"] = cost
+            attempt["time"] = time.time() - attempt_start
+            self.health.record(current_model.key, True, attempt["time"])
+
+            if self.cache is not None:
+                self.cache.put(ResponseCache.key(current_model.model_id, context_hash), {"text": response_text})
+
+            yield {
+                "text": response_text, 
+                "model": current_model.model_id, 
+                "cost": cost, 
+                "time": time.time() - start,
+                "attempts": attempts}
+            return
+
+        raise ModelsFailed(attempts)
+
+    def call_batch(self, models, contexts, concurrency=8, retries=5):
+
+        """
+        Calls the models for each context on its own, concurrency at a time.
+        When all models are throttled the call is retried after an exponential backoff with jitter.
+        Returns the answers in the order of contexts (a dict with "error" for the failed ones),
+        the total cost, the time and the throughput in calls per second.
+        """
+
+        start = time.time()
+
+        def call_one(context):
+            for retry in range(retries + 1):
+                try:
+                    return self.call(models, context)
+                except ModelsFailed as e:
+                    if not e.throttled() or retry == retries:
+                        return {"error": str(e), "attempts": e.attempts}
+                    time.sleep(min(30, 2 ** retry) * random.uniform(0.5, 1.5))
+                except Exception as e:
+                    return {"error": str(e)}
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(call_one, contexts))
+
+        elapsed = time.time() - start
+        return {
+            "results": results,
+            "cost": sum([r.get("cost", 0) for r in results]),
+            "failed": len([r for r in results if "error" in r]),
+            "time": elapsed,
+            "throughput": len(results) / elapsed if elapsed else 0.0}
+
+    async def _async_client(self):
+        loop = asyncio.get_running_loop()
+        task = self._async_clients.get(loop)
+        if task is None:
+            # a task, so that concurrent first calls share one client
+            task = self._async_clients[loop] = asyncio.ensure_future(self._create_async_client())
+        try:
+            return await task
+        except Exception:
+            # the next call tries again
+            if self._async_clients.get(loop) is task:
+                del self._async_clients[loop]
+            raise
+
+    async def _create_async_client(self):
+        try:
+            from aiobotocore.config import AioConfig
+            from aiobotocore.session import get_session
+        except ImportError:
+            raise Exception("call_async needs aiobotocore, pip install aiobotocore")
+
+        stack = AsyncExitStack()
+        client = await stack.enter_async_context(get_session().create_client(
+            "bedrock-runtime",
+            region_name=os.environ.get('AWS_REGION'),
+            endpoint_url=self._endpoint_url,
+            config=AioConfig(max_pool_connections=self.max_connections)))
+        # asyncio.run cancels the tasks still pending when it ends, this one then closes the client
+        closer = asyncio.ensure_future(self._close_at_shutdown(stack))
+        self._async_closers.add(closer)
+        closer.add_done_callback(self._async_closers.discard)
+        return client, stack, asyncio.Semaphore(self.max_concurrency)
+
+    async def _close_at_shutdown(self, stack):
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.create_future()
+        finally:
+            self._async_clients.pop(loop, None)
+            await stack.aclose()
+
+    async def close_async(self):
+        """
+        Closes the async client of the running event loop.
+        asyncio.run does it when it ends, a loop run otherwise needs this before it is closed.
+        """
+        task = self._async_clients.pop(asyncio.get_running_loop(), None)
+        if task is not None:
+            _, stack, _ = await task
+            await stack.aclose()
+
+    async def call_async(self, models, context, context_text_length=None, hedge_after=None):
+
+        """
+        The same as call but on an aiobotocore client shared by the event loop,
+        so many calls can be in flight without a thread each.
+        At most max_concurrency model calls run at once, the rest wait for a slot.
+        """
+
+        start = time.time()
+
+        if context_text_length is None:
+            context_text_length = sum([len(c.text) for c in context])
+
+        if hedge_after is None:
+            hedge_after = self.hedge_after
+
+        candidates = self._candidates(models, context_text_length)
+
+        context_hash, answer = self._cached(candidates, context)
+        if answer is not None:
+            return answer
+
+        client, _, semaphore = await self._async_client()
+        conversation, cache_points = self._conversation(context)
+        attempts = []
+        pending = {}
+
+        # when each attempt's call started, None while it waits for the semaphore
+        started = []
+
+        async def converse(i, current_model):
+            async with semaphore:
+                converse_start = started[i] = time.time()
+                try:
+                    response = await client.converse(
+                        modelId=current_model.model_id,
+                        messages=self._messages(current_model, conversation, cache_points),
+                        inferenceConfig={
+                            "maxTokens": current_model.out_length,
+                            },
+                    )
+                    result = self._parse(current_model, response)
+                except Exception:
+                    self.health.record(current_model.key, False, time.time() - converse_start)
+                    raise
+            self.health.record(current_model.key, True, time.time() - converse_start)
+            return result
+
+        def attempt_next():
+            current_model = candidates[len(attempts)]
+            attempt = {"model": current_model.model_id, "status": "running", "cost": None, "time": None}
+            attempts.append(attempt)
+            started.append(None)
+            task = asyncio.ensure_future(converse(len(attempts) - 1, current_model))
+            pending[task] = (current_model, attempt, len(attempts) - 1)
+
+        def elapsed(i):
+            return time.time() - started[i] if started[i] is not None else 0.0
+
+        if candidates:
+            attempt_next()
+
+        try:
+            while pending:
+
+                can_hedge = hedge_after is not None and len(attempts) < len(candidates)
+                timeout = None
+                if can_hedge:
+                    # counted from when the last call started, not from when it was queued
+                    timeout = max(0.0, hedge_after - elapsed(len(attempts) - 1))
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+                if not done:
+                    if started[-1] is not None and elapsed(len(attempts) - 1) >= hedge_after:
+                        attempt_next()
+                    continue
+
+                for task in done:
+                    current_model, attempt, i = pending.pop(task)
+                    attempt["time"] = elapsed(i)
+                    try:
+                        response_text, cost = task.result()
+                    except Exception as e:
+                        print(f"Model {current_model.key} failed at {datetime.now()}: {e}")
+                        attempt["status"] = "failed"
+                        attempt["error"] = str(e)
+                        if len(attempts) < len(candidates):
+                            attempt_next()
+                        continue
+
+                    attempt["status"] = "succeeded"
+                    attempt["cost"] = cost
+
+                    if self.cache is not None:
+                        self.cache.put(ResponseCache.key(current_model.model_id, context_hash), {"text": response_text})
+
+                    return {
+                        "text": response_text, 
+                        "model": current_model.model_id, 
+                        "cost": cost, 
+                        "time": time.time() - start,
+                        "attempts": attempts}
+        finally:
+            # unlike threads, the other calls can be cancelled
+            for task, (_, attempt, i) in pending.items():
+                task.cancel()
+                attempt["status"] = "cancelled"
+                attempt["time"] = elapsed(i)
+
+        raise ModelsFailed(attempts)
+
+def decode_text(chunks, limit):
+    """
+    Decodes chunks of bytes as UTF-8 one at a time, a character split between chunks is kept whole.
+    Returns the text and None, or None and why: "too large" past limit bytes, "binary".
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    parts = []
+    size = 0
+    for chunk in chunks:
+        size += len(chunk)
+        if size > limit:
+            return None, "too large"
+        # a NUL byte does not occur in text files
+        if b"\0" in chunk:
+            return None, "binary"
+        parts.append(decoder.decode(chunk))
+    parts.append(decoder.decode(b"", final=True))
+    return "".join(parts), None
 
 class ContextItem():
 
-    def __init__(self, text, type, model=None):
-        self.text = text
+    def __init__(self, text, type, model=None, blob=None, length=None, blobs=None, tag=None):
+        # the text of a file is kept once in the store by its hash (blob) and read when needed
+        self._text = text
         self.type = type
         self.model = model
+        self.blob = blob
+        self._blobs = blobs
+        self.length = length if length is not None else len(text)
+        # set by the caller to find the item again, such as the id of a message or a file
+        self.tag = tag
+        # the parts of a file picked for one question, see Retriever
+        self.retrieved = False
+        # the item's row in the store, None until it is written
+        self.seq = None
+
+    @property
+    def text(self):
+        if self._text is None:
+            return self._blobs.get_blob(self.blob)
+        return self._text
+
+    def __setstate__(self, state):
+        # items pickled before blobs have a plain text attribute
+        if "text" in state:
+            state["_text"] = state.pop("text")
+        state.setdefault("model", None)
+        state.setdefault("blob", None)
+        state.setdefault("_blobs", None)
+        state.setdefault("length", len(state["_text"]))
+        state.setdefault("tag", None)
+        state.setdefault("retrieved", False)
+        state["seq"] = None
+        self.__dict__.update(state)
 
     def to_dict(self):
-        return {"text": self.text, "type": self.type}
+        return {"text": self.text, "type": self.type, "model": self.model, "tag": self.tag}
 
     @classmethod
     def from_dict(cls, data):
-        return cls(text=data["text"], item_type=data["type"])
+        return cls(text=data["text"], type=data["type"], model=data.get("model"), tag=data.get("tag"))
+
+class ContextIndex():
+
+    """
+    Running prefix sums of the text lengths of a conversation, total and "in" only,
+    so that lengths are O(1) and trimming is a binary search instead of a walk over the history.
+    """
+
+    def __init__(self, items=()):
+        # the sums before item i are at i + self._start, items dropped from the front just move the start
+        self._start = 0
+        self._total = [0]
+        self._in = [0]
+        for item in items:
+            self.append(item)
+
+    def __len__(self):
+        return len(self._total) - 1 - self._start
+
+    def append(self, item):
+        length = item.length
+        self._total.append(self._total[-1] + length)
+        self._in.append(self._in[-1] + (length if item.type == "in" else 0))
+
+    def drop_front(self, count):
+        self._start += count
+        if self._start > len(self._total) // 2:
+            self._total = self._total[self._start:]
+            self._in = self._in[self._start:]
+            self._start = 0
+
+    def truncate(self, count):
+        """
+        Keeps the first count items
+        """
+        del self._total[self._start + count + 1:]
+        del self._in[self._start + count + 1:]
+
+    def length(self):
+        return self._total[-1] - self._total[self._start]
+
+    def length_before(self, count):
+        """
+        Returns the length of the first count items
+        """
+        return self._total[self._start + count] - self._total[self._start]
+
+    def in_length(self):
+        return self._in[-1] - self._in[self._start]
+
+    def out_length(self):
+        return self.length() - self.in_length()
+
+    def trim_count(self, max_length, extra_length=0):
+        """
+        Returns how many items to drop from the front
+        so that the rest plus extra_length fits into max_length
+        """
+        target = self._total[-1] + extra_length - max_length
+        i = bisect.bisect_left(self._total, target, lo=self._start)
+        return min(i - self._start, len(self))
+
+class ContextStore():
+
+    """
+    Keeps the context items of every conversation in SQLite (WAL mode).
+    Each item is a row keyed by (context_id, seq), so a new message
+    is an insert for that conversation only instead of a rewrite of all of them.
+    The store hands out the seqs and never reuses one, and a version per conversation
+    tells a process that another one wrote the conversation since it read it.
+    File contents are blobs keyed by their sha256, stored once however many
+    conversations have them. The recently read ones are kept in memory,
+    up to blob_cache_size characters. Blobs no item refers to are deleted
+    once they are blob_grace seconds old, when the store is opened and after deletes.
+    """
+
+    def __init__(self, path="contexts.db", legacy_path="contexts.pkl", blob_cache_size=None, blob_grace=None):
+        migrate = not os.path.exists(path) and os.path.exists(legacy_path)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS items ("
+            "context_id TEXT NOT NULL, seq INTEGER NOT NULL, "
+            "text TEXT NOT NULL, type TEXT NOT NULL, model TEXT, "
+            "PRIMARY KEY (context_id, seq))")
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(items)")}
+        if "blob" not in columns:
+            self._conn.execute("ALTER TABLE items ADD COLUMN blob TEXT")
+            self._conn.execute("ALTER TABLE items ADD COLUMN length INTEGER")
+        if "tag" not in columns:
+            self._conn.execute("ALTER TABLE items ADD COLUMN tag TEXT")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS blobs (hash TEXT PRIMARY KEY, text TEXT NOT NULL)")
+        if "created" not in {row[1] for row in self._conn.execute("PRAGMA table_info(blobs)")}:
+            self._conn.execute("ALTER TABLE blobs ADD COLUMN created REAL")
+        # to find the blobs no item refers to
+        self._conn.execute("CREATE INDEX IF NOT EXISTS items_blob ON items (blob)")
+        # the next seq and the number of writes per conversation
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS conversations ("
+            "context_id TEXT PRIMARY KEY, next_seq INTEGER NOT NULL, version INTEGER NOT NULL)")
+        # what a chat UI shows per conversation, one JSON entry per message
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS history ("
+            "context_id TEXT NOT NULL, seq INTEGER NOT NULL, entry TEXT NOT NULL, "
+            "PRIMARY KEY (context_id, seq))")
+        # files added to a conversation from disk, to add only the changed ones again
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS manifest ("
+            "context_id TEXT NOT NULL, path TEXT NOT NULL, mtime REAL NOT NULL, size INTEGER NOT NULL, hash TEXT NOT NULL, "
+            "PRIMARY KEY (context_id, path))")
+        self._conn.commit()
+        # an LRU of blob texts
+        self._blobs = OrderedDict()
+        self._blobs_size = 0
+        self.blob_cache_size = blob_cache_size if blob_cache_size is not None else int(os.environ.get('BEDROCK_BLOB_CACHE_SIZE', 64 * 1024 * 1024))
+        # a blob is stored before the item that refers to it is written, younger ones are kept
+        self.blob_grace = blob_grace if blob_grace is not None else float(os.environ.get('BEDROCK_BLOB_GRACE', 3600))
+        self._blobs_collected = 0
+
+        # for version checks, which do not wait for a write in progress
+        self._version_lock = threading.Lock()
+        self._version_conn = sqlite3.connect(path, check_same_thread=False)
+
+        if migrate:
+            # one-time import of the old all-in-one pickle
+            with open(legacy_path, 'rb') as f:
+                for context_id, context in pickle.load(f).items():
+                    self.write(context_id, (), context, 0)
+
+        self.collect_blobs()
+
+    def load(self, context_id):
+        """
+        Returns the version of the conversation and its ContextItem objects in seq order
+        """
+        with self._lock:
+            # one read transaction so that the version matches the rows
+            self._conn.execute("BEGIN")
+            try:
+                row = self._conn.execute("SELECT version FROM conversations WHERE context_id = ?", (context_id,)).fetchone()
+                rows = self._conn.execute(
+                    "SELECT seq, text, type, model, blob, length, tag FROM items WHERE context_id = ? ORDER BY seq",
+                    (context_id,)).fetchall()
+            finally:
+                self._conn.commit()
+        items = []
+        for seq, text, type, model, blob, length, tag in rows:
+            if blob:
+                item = ContextItem(text=None, type=type, model=model, blob=blob, length=length, blobs=self, tag=tag)
+            else:
+                item = ContextItem(text=text, type=type, model=model, tag=tag)
+            item.seq = seq
+            items.append(item)
+        return row[0] if row else 0, items
+
+    def version(self, context_id):
+        with self._version_lock:
+            row = self._version_conn.execute("SELECT version FROM conversations WHERE context_id = ?", (context_id,)).fetchone()
+        return row[0] if row else 0
+
+    def write(self, context_id, deleted, items, version):
+        """
+        Deletes the rows with the deleted seqs and appends items after all rows,
+        in a single transaction. Returns the seqs of items, the new version
+        and whether another writer changed the conversation since version.
+        """
+        with self._lock:
+            with self._conn:
+                # takes the write lock before reading next_seq
+                self._conn.execute("BEGIN IMMEDIATE")
+                row = self._conn.execute(
+                    "SELECT next_seq, version FROM conversations WHERE context_id = ?", (context_id,)).fetchone()
+                if row is None:
+                    # written before conversations were counted
+                    last = self._conn.execute("SELECT MAX(seq) FROM items WHERE context_id = ?", (context_id,)).fetchone()[0]
+                    row = (last + 1 if last is not None else 0, 0)
+                next_seq, stored_version = row
+                self._conn.executemany(
+                    "DELETE FROM items WHERE context_id = ? AND seq = ?", [(context_id, seq) for seq in deleted])
+                self._conn.executemany(
+                    "INSERT INTO items (context_id, seq, text, type, model, blob, length, tag) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [(context_id, next_seq + i, "" if item.blob else item.text, item.type, item.model, item.blob, item.length, item.tag)
+                     for i, item in enumerate(items)])
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO conversations VALUES (?, ?, ?)",
+                    (context_id, next_seq + len(items), stored_version + 1))
+        if deleted and time.time() - self._blobs_collected > self.blob_grace:
+            self.collect_blobs()
+        return list(range(next_seq, next_seq + len(items))), stored_version + 1, stored_version != version
+
+    def collect_blobs(self):
+        """
+        Deletes the blobs older than blob_grace that no item refers to, returns how many
+        """
+        now = time.time()
+        with self._lock:
+            with self._conn:
+                self._conn.execute("BEGIN IMMEDIATE")
+                unused = [blob for blob, in self._conn.execute(
+                    "SELECT hash FROM blobs WHERE (created IS NULL OR created < ?) "
+                    "AND NOT EXISTS (SELECT 1 FROM items WHERE items.blob = blobs.hash)", (now - self.blob_grace,))]
+                self._conn.executemany("DELETE FROM blobs WHERE hash = ?", [(blob,) for blob in unused])
+            for blob in unused:
+                text = self._blobs.pop(blob, None)
+                if text is not None:
+                    self._blobs_size -= len(text)
+            self._blobs_collected = now
+        return len(unused)
+
+    def put_blob(self, text):
+        """
+        Stores text once by its hash and returns the hash
+        """
+        blob = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        with self._lock:
+            # not cached, an uploaded file may never be read. Always written, another process may have collected it
+            with self._conn:
+                self._conn.execute(
+                    "INSERT INTO blobs (hash, text, created) VALUES (?, ?, ?) ON CONFLICT (hash) DO UPDATE SET created = excluded.created",
+                    (blob, text, time.time()))
+        return blob
+
+    def get_blob(self, blob):
+        with self._lock:
+            text = self._blobs.get(blob)
+            if text is not None:
+                self._blobs.move_to_end(blob)
+                return text
+            text = self._conn.execute("SELECT text FROM blobs WHERE hash = ?", (blob,)).fetchone()[0]
+            if len(text) <= self.blob_cache_size:
+                self._blobs[blob] = text
+                self._blobs_size += len(text)
+                while self._blobs_size > self.blob_cache_size:
+                    _, evicted = self._blobs.popitem(last=False)
+                    self._blobs_size -= len(evicted)
+        return text
+
+    def load_history(self, context_id, start=0):
+        """
+        Returns the history entries of a conversation from index start on
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT entry FROM history WHERE context_id = ? AND seq >= ? ORDER BY seq",
+                (context_id, start)).fetchall()
+        return [json.loads(entry) for entry, in rows]
+
+    def history_length(self, context_id):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM history WHERE context_id = ?", (context_id,)).fetchone()[0]
+
+    def put_history(self, context_id, index, entry):
+        """
+        Sets the entry at index, which is at most the history length, and drops the entries after it.
+        Returns the new history length.
+        """
+        with self._lock:
+            with self._conn:
+                self._conn.execute("DELETE FROM history WHERE context_id = ? AND seq >= ?", (context_id, index))
+                self._conn.execute("INSERT INTO history VALUES (?, ?, ?)", (context_id, index, json.dumps(entry)))
+        return index + 1
+
+    def load_manifest(self, context_id):
+        """
+        Returns {path: (mtime, size, hash)} of the files added to a conversation
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT path, mtime, size, hash FROM manifest WHERE context_id = ?", (context_id,)).fetchall()
+        return {path: (mtime, size, hash) for path, mtime, size, hash in rows}
+
+    def put_manifest(self, context_id, files):
+        """
+        files is a list of (path, mtime, size, hash)
+        """
+        with self._lock:
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?, ?)",
+                    [(context_id, path, mtime, size, hash) for path, mtime, size, hash in files])
+
+    def truncate_history(self, context_id, length=0):
+        with self._lock:
+            with self._conn:
+                self._conn.execute("DELETE FROM history WHERE context_id = ? AND seq >= ?", (context_id, length))
 
 class Context():
 
-    def __init__(self, bedrock):
+    """
+    Conversations in memory, written to the store behind the requests:
+    a background thread writes the changed conversations every flush_interval seconds,
+    or sooner once flush_items new items are waiting, and once more at exit or on SIGTERM.
+    flush_interval 0 writes on every change.
+    A conversation that another process wrote since is read again, merged with what is not written yet.
+    """
+
+    def __init__(self, bedrock, flush_interval=None, flush_items=None):
         self._bedrock = bedrock
+        self._lock = threading.RLock()
 
-        if os.path.exists("contexts.pkl"):
-            with open('contexts.pkl', 'rb') as f:
-                self._contexts = pickle.load(f)
-        else:
-            self._contexts = {}
+        # conversations are loaded from the store on first access
+        self._store = ContextStore()
+        # for what else is kept per conversation, such as the chat history a UI shows
+        self.store = self._store
+        self._contexts = {}
+        # per conversation as last set: the items, their lengths and the store version they are based on
+        self._stored = {}
+        self._index = {}
+        self._version = {}
 
+        self._model_dict = {model.key: model for model in self._bedrock.models}
+
+        # models.pkl holds the model key per conversation, older files hold Model objects
+        # that lack attributes added since, so both become this Bedrock's models
+        self._user_models = {}
         if os.path.exists("models.pkl"):
             with open('models.pkl', 'rb') as f:
-                self._user_models = pickle.load(f)
-        else:   
-            self._user_models = {}
+                for context_id, model in pickle.load(f).items():
+                    key = model if isinstance(model, str) else model.key
+                    if key in self._model_dict:
+                        self._user_models[context_id] = self._model_dict[key]
 
-        self._model_dict = {model.key: model for model in self._bedrock.models}
+        # the conversations to write, the seqs of their rows to delete, and the ones being written
+        self._dirty = set()
+        self._deleted = {}
+        self._flushing = set()
+        self._dirty_items = 0
+        self._models_dirty = False
+        self._flush_lock = threading.Lock()
+
+        if flush_interval is None:
+            flush_interval = float(os.environ.get('BEDROCK_FLUSH_INTERVAL', 1))
+        if flush_items is None:
+            flush_items = int(os.environ.get('BEDROCK_FLUSH_ITEMS', 100))
+        self.flush_interval = flush_interval
+        self.flush_items = flush_items
+        self._sigterm_installed = False
+
+        if self.flush_interval > 0:
+            self._wake = threading.Event()
+            threading.Thread(target=self._flusher, name="context-flusher", daemon=True).start()
+            atexit.register(self.flush)
+            if threading.current_thread() is threading.main_thread():
+                self.install_shutdown_flush()
+
+    def install_shutdown_flush(self):
+        """
+        Flushes on SIGTERM too. Ctrl-C raises KeyboardInterrupt and ends with atexit,
+        SIGTERM (how services are stopped) does not. A signal handler can only be set on the main thread,
+        a service that first uses the context on another thread calls this from the main thread at startup.
+        """
+        with self._lock:
+            if self.flush_interval <= 0 or self._sigterm_installed:
+                return
+            self._previous_sigterm = signal.signal(signal.SIGTERM, self._on_sigterm)
+            self._sigterm_installed = True
+
+    def _on_sigterm(self, signum, frame):
+        # in a thread, the main thread may be holding the locks where the signal interrupted it
+        flusher = threading.Thread(target=self.flush, name="context-flush-on-exit")
+        flusher.start()
+        flusher.join(10)
+        previous = self._previous_sigterm
+        if callable(previous):
+            previous(signum, frame)
+        elif previous != signal.SIG_IGN:
+            # the default action, terminate
+            signal.signal(signum, signal.SIG_DFL)
+            os.kill(os.getpid(), signum)
+
+    def _flusher(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the changed conversations and models to the store
+        """
+        with self._flush_lock:
+            with self._lock:
+                writes = [self._take_write(context_id) for context_id in list(self._dirty)]
+                self._dirty_items = 0
+                user_models = {context_id: model.key for context_id, model in self._user_models.items()} if self._models_dirty else None
+                self._models_dirty = False
+
+            for write in writes:
+                self._write(*write)
+
+            if user_models is not None:
+                with open('models.pkl', 'wb') as f:
+                    pickle.dump(user_models, f)
+
+    def _take_write(self, context_id):
+        """
+        Returns what to write for a conversation: the rows to delete and the items without a row
+        """
+        self._dirty.discard(context_id)
+        self._flushing.add(context_id)
+        items = [item for item in self._stored[context_id] if item.seq is None]
+        return context_id, self._deleted.pop(context_id, set()), items, self._version[context_id]
+
+    def _write(self, context_id, deleted, items, version):
+        try:
+            seqs, version, moved = self._store.write(context_id, deleted, items, version)
+        except Exception as e:
+            print(f"Failed to save context {context_id} at {datetime.now()}: {e}")
+            with self._lock:
+                self._flushing.discard(context_id)
+                self._deleted.setdefault(context_id, set()).update(deleted)
+                self._dirty.add(context_id)
+            return
+
+        with self._lock:
+            self._flushing.discard(context_id)
+            for item, seq in zip(items, seqs):
+                item.seq = seq
+            self._version[context_id] = version
+            # items removed while they were being written
+            current = {id(item) for item in self._stored[context_id]}
+            gone = [item.seq for item in items if id(item) not in current]
+            if gone:
+                self._deleted.setdefault(context_id, set()).update(gone)
+            if moved:
+                # another process wrote this conversation too, take its rows in
+                self._load(context_id)
+            if gone:
+                self._changed(context_id, (), 0)
+
+    def _changed(self, context_id, removed, added):
+        """
+        Records a change of a conversation: the rows with the removed seqs are gone
+        and added items have no row yet. Changes are merged until the next flush.
+        """
+        if removed:
+            self._deleted.setdefault(context_id, set()).update(removed)
+        if self.flush_interval <= 0:
+            self._write(*self._take_write(context_id))
+            return
+        self._dirty.add(context_id)
+        self._dirty_items += added
+        if self._dirty_items >= self.flush_items:
+            self._wake.set()
+
+    def _models_changed(self):
+        if self.flush_interval <= 0:
+            with open('models.pkl', 'wb') as f:
+                pickle.dump({context_id: model.key for context_id, model in self._user_models.items()}, f)
+            return
+        self._models_dirty = True
 
     def get_context(self, context_id):
-        return self._contexts.get(context_id, [])
-    
+        with self._lock:
+            if context_id not in self._contexts:
+                self._load(context_id)
+            elif context_id not in self._flushing and self._store.version(context_id) != self._version[context_id]:
+                # another process wrote this conversation since
+                self._load(context_id)
+            return self._contexts[context_id]
+
+    def _load(self, context_id):
+        """
+        Reads a conversation from the store. Items already in memory are kept as they are,
+        items that have no row yet follow the stored ones and rows waiting to be deleted are left out.
+        """
+        version, items = self._store.load(context_id)
+        stored = self._stored.get(context_id, [])
+        known = {item.seq: item for item in stored if item.seq is not None}
+        deleted = self._deleted.get(context_id, ())
+        merged = [known.get(item.seq, item) for item in items if item.seq not in deleted]
+        merged += [item for item in stored if item.seq is None]
+
+        context = self._contexts.get(context_id)
+        if context is None:
+            context = list(merged)
+        else:
+            # the caller may be appending to the list it got from get_context,
+            # it gets the new rows in place and keeps what it appended
+            stored_ids = {id(item) for item in stored}
+            context[:] = merged + [item for item in context if id(item) not in stored_ids]
+        self._contexts[context_id] = context
+        self._stored[context_id] = merged
+        self._index[context_id] = ContextIndex(merged)
+        self._version[context_id] = version
+
     def context_length(self, context_id):
-        return sum([len(item.text) for item in self.get_context(context_id)])
+        self.get_context(context_id)
+        return self._index[context_id].length()
+
+    def context_with(self, context_id, items):
+        """
+        Returns the stored context followed by items, trimmed to the longest model,
+        and its length
+        """
+        self.get_context(context_id)
+        index = self._index[context_id]
+        items_length = sum([item.length for item in items])
+        max_length = self._bedrock.longest_model.in_length
+        if items_length > max_length:
+            return [], 0
+        drop = index.trim_count(max_length, items_length)
+        context = self._stored[context_id][drop:] + list(items)
+        return context, index.length() - index.length_before(drop) + items_length
     
     def set_context(self, context_id, context):
-        context, _ = self.trim_context(context)
+        """
+        Trims the context to the longest model and writes only the difference
+        between the stored items and the context: the rows of removed items are deleted,
+        new items are appended. Items are compared by identity because callers append
+        to the list returned by get_context.
+        """
+        with self._lock:
+            self._set_context(context_id, context)
+
+    def _set_context(self, context_id, context):
+        self.get_context(context_id)
+        stored = self._stored[context_id]
+        index = self._index[context_id]
+
+        # where the new context starts in the stored one
+        start = -1
+        if context:
+            for i in range(len(stored)):
+                if stored[i] is context[0]:
+                    start = i
+                    break
+
+        common = 0
+        if start == -1:
+            index = ContextIndex()
+        else:
+            while start + common < len(stored) and common < len(context) and stored[start + common] is context[common]:
+                common += 1
+            index.drop_front(start)
+            index.truncate(common)
+        for item in context[common:]:
+            index.append(item)
+
+        drop = index.trim_count(self._bedrock.longest_model.in_length)
+        index.drop_front(drop)
+        context = context[drop:] if drop else context
+
+        # rows are read back in seq order, so a stored item that now follows a new or a moved one is written again
+        stored_ids = {id(item) for item in stored}
+        kept = []
+        for item in context:
+            if item.seq is None or id(item) not in stored_ids or (kept and item.seq <= kept[-1].seq):
+                break
+            kept.append(item)
+        kept_seqs = {item.seq for item in kept}
+        removed = [item.seq for item in stored if item.seq is not None and item.seq not in kept_seqs]
+        for item in context[len(kept):]:
+            item.seq = None
+        added = len(context) - len(kept)
+
         self._contexts[context_id] = context
+        self._stored[context_id] = list(context)
+        self._index[context_id] = index
+        if removed or added:
+            self._changed(context_id, removed, added)
 
-        with open('contexts.pkl', 'wb') as f:
-            pickle.dump(self._contexts, f)
+    def file_item(self, text, tag=None):
+        """
+        Returns a context item for the content of a file, the text is stored once by its hash
+        """
+        blob = self._store.put_blob(text)
+        return ContextItem(text=None, type="in", blob=blob, length=len(text), blobs=self._store, tag=tag)
 
     def remove_from_context(self, context_id, count):
         context = self.get_context(context_id)
         context = context[:-count]
         self.set_context(context_id, context)
 
+    def remove_tagged(self, context_id, tags):
+        """
+        Removes the items with any of the tags wherever they are,
+        their rows are deleted and the other items are not written again.
+        Returns how many were removed.
+        """
+        with self._lock:
+            context = self.get_context(context_id)
+            kept = [item for item in context if item.tag not in tags]
+            if len(kept) < len(context):
+                self._set_context(context_id, kept)
+            return len(context) - len(kept)
+
     def _get_model(self, context_id):
         if context_id in self._user_models:
             return self._user_models[context_id]
         else:
-            context = self._contexts.get(context_id, [])
-            models = self._sort_models(context_id, context)
+            models = self._sort_models(context_id)
             return models[0]
     
     def set_model(self, context_id, model_key):
-        self._user_models[context_id] = self._model_dict[model_key]
-
-        with open('models.pkl', 'wb') as f:
-            pickle.dump(self._user_models, f)
+        with self._lock:
+            self._user_models[context_id] = self._model_dict[model_key]
+            self._models_changed()
 
     def reset_model(self, context_id):
-        self._user_models = {}
-
-        with open('models.pkl', 'wb') as f:
-            pickle.dump(self._user_models, f)
-
-    # @classmethod
-    def trim_context(self, context :List[ContextItem]):
-        context_text_length = 0
-        for i in range(len(context)):
-            idx = i + 1
-            context_text_length += len(context[-idx].text)
-            if context_text_length > self._bedrock.longest_model.in_length:
-                context_text_length -= len(context[-idx].text)
-                if i == 0:
-                    context = []
-                else:
-                    context = context[-i:]
-                break
-        return context, context_text_length
+        with self._lock:
+            self._user_models.pop(context_id, None)
+            self._models_changed()
 
     def clear_context(self, context_id):
         self.set_context(context_id, [])
 
-    def _sort_models(self, context_id, context=None):
+    def _sort_models(self, context_id):
         
         """
         Sorts the models by price for a user.
         If the user specified a model, put it first.
         """
 
-        if context is None:
-            context = self.get_context(context_id)
+        self.get_context(context_id)
+        index = self._index[context_id]
 
-        if len(context) == 0:
+        if len(index) == 0:
             sorted_by_price = sorted(self._bedrock.models, key=lambda x: x.in_price)
         else:
-            in_length = 0
-            out_length = 0
-            for c in context:
-                if c.type == "in":
-                    in_length += len(c.text)
-                else:
-                    out_length += len(c.text)
+            in_length = index.in_length()
+            out_length = index.out_length()
 
             sorted_by_price = sorted(
                 self._bedrock.models, key=lambda x: x.in_price * in_length + x.out_price * out_length)
@@ -218,52 +1483,241 @@ class Context():
         
     def get_models(self, context_id):
         model = self._get_model(context_id)
-        current_context = self.get_context(context_id)
-        models = self._sort_models(context_id, current_context)
+        models = self._sort_models(context_id)
         if model != models[0]:
-            models = [model].extend([m for m in models if m != model])
+            models = [model] + [m for m in models if m != model]
         return models
     
+class ChunkIndex():
+
+    """
+    The text of one file cut into chunks of about chunk_size characters on line breaks,
+    with an inverted index of the words in each chunk
+    """
+
+    def __init__(self, text, chunk_size):
+        self.chunks = []
+        chunk = []
+        chunk_length = 0
+        for line in text.splitlines(keepends=True):
+            # lines longer than a chunk are cut
+            while len(line) > chunk_size:
+                self.chunks.append(line[:chunk_size])
+                line = line[chunk_size:]
+            if chunk_length + len(line) > chunk_size and chunk:
+                self.chunks.append("".join(chunk))
+                chunk = []
+                chunk_length = 0
+            chunk.append(line)
+            chunk_length += len(line)
+        if chunk:
+            self.chunks.append("".join(chunk))
+
+        # word -> [(chunk number, count in the chunk)]
+        self.postings = {}
+        self.lengths = []
+        for i, chunk in enumerate(self.chunks):
+            words = tokenize(chunk)
+            self.lengths.append(len(words))
+            counts = {}
+            for word in words:
+                counts[word] = counts.get(word, 0) + 1
+            for word, count in counts.items():
+                self.postings.setdefault(word, []).append((i, count))
+
+def tokenize(text):
+    return [word for word in re.findall(r"[a-z0-9_]+", text.lower()) if len(word) > 1]
+
+class Retriever():
+
+    """
+    Picks the chunks of the attached files that are relevant to the question with BM25,
+    when the context with the files is longer than the model that answers takes.
+    top_k 0 turns it off.
+    """
+
+    def __init__(self, top_k=None, chunk_size=None, max_indexes=256):
+        self.top_k = top_k if top_k is not None else int(os.environ.get('BEDROCK_RETRIEVAL_TOP_K', 8))
+        self.chunk_size = chunk_size or int(os.environ.get('BEDROCK_RETRIEVAL_CHUNK_SIZE', 2000))
+        self._lock = threading.Lock()
+        # chunk indexes by blob hash, the same file is indexed once for all chats
+        self._indexes = OrderedDict()
+        self._max_indexes = max_indexes
+
+    def _index(self, item):
+        with self._lock:
+            index = self._indexes.get(item.blob)
+            if index is not None:
+                self._indexes.move_to_end(item.blob)
+                return index
+        index = ChunkIndex(item.text, self.chunk_size)
+        with self._lock:
+            self._indexes[item.blob] = index
+            while len(self._indexes) > self._max_indexes:
+                self._indexes.popitem(last=False)
+        return index
+
+    def select(self, context, question, max_length, k1=1.5, b=0.75):
+        """
+        When the context is longer than max_length characters, returns it with each file replaced
+        by its chunks among the top_k for the question, files without such chunks are left out.
+        Returns the context as is when it fits or nothing matches.
+        """
+        files = [i for i, item in enumerate(context) if item.blob]
+        if self.top_k <= 0 or not files or sum([item.length for item in context]) <= max_length:
+            return context
+
+        indexes = {i: self._index(context[i]) for i in files}
+        chunk_count = sum([len(index.chunks) for index in indexes.values()])
+        average_length = sum([sum(index.lengths) for index in indexes.values()]) / max(chunk_count, 1)
+
+        scores = {}
+        for word in set(tokenize(question)):
+            found = sum([len(index.postings.get(word, [])) for index in indexes.values()])
+            if not found:
+                continue
+            idf = math.log(1 + (chunk_count - found + 0.5) / (found + 0.5))
+            for i, index in indexes.items():
+                for chunk, count in index.postings.get(word, []):
+                    length_norm = 1 - b + b * index.lengths[chunk] / max(average_length, 1)
+                    scores[(i, chunk)] = scores.get((i, chunk), 0) + idf * count * (k1 + 1) / (count + k1 * length_norm)
+
+        if not scores:
+            return context
+
+        selected = {}
+        for (i, chunk), _ in heapq.nlargest(self.top_k, scores.items(), key=lambda x: x[1]):
+            selected.setdefault(i, []).append(chunk)
+
+        result = []
+        for i, item in enumerate(context):
+            if i not in indexes:
+                result.append(item)
+            elif i in selected:
+                chunks = indexes[i].chunks
+                chunk_item = ContextItem(text="\n...\n".join([chunks[c] for c in sorted(selected[i])]), type=item.type)
+                # different for every question, not worth a prompt cache point
+                chunk_item.retrieved = True
+                result.append(chunk_item)
+        return result
+
+class LazyClassAttribute():
+
+    """
+    A class attribute that is created by factory on first access, once, even from many threads
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._value = None
+
+    def __get__(self, instance, owner):
+        if self._value is None:
+            with self._lock:
+                if self._value is None:
+                    self._value = self._factory()
+        return self._value
+
 class Chat():
 
-    bedrock_client = Bedrock()
-    context_manager = Context(bedrock_client)
+    # created on first use so that importing this module is fast
+    bedrock_client = LazyClassAttribute(Bedrock)
+    context_manager = LazyClassAttribute(lambda: Context(Chat.bedrock_client))
+    retriever = LazyClassAttribute(Retriever)
 
     def __init__(self, context_id):
         self._context_id = context_id
     
-    def ask(self, question):
-
-        context = Chat.context_manager.get_context(self._context_id)
-        current_context = []
-        current_context.extend(context)
-
-        current_context.append(ContextItem(text=question, type="in"))
+    def _prepare(self, question):
 
         # make sure that the current context does not exceed the max length
-        current_context, context_text_length = Chat.context_manager.trim_context(current_context)
-        
+        current_context, context_text_length = Chat.context_manager.context_with(
+            self._context_id, [ContextItem(text=question, type="in")])
+
         # get the cheapest model for this channel:user
         models = Chat.context_manager.get_models(self._context_id)
 
-        try:
-        
-            # send the question with the context to bedrock
-            answer = Chat.bedrock_client.call(models, current_context)
+        # when the context is too long for that model, send only the parts of the attached files relevant to the question
+        selected_context = Chat.retriever.select(current_context, question, models[0].in_length)
+        if selected_context is not current_context:
+            current_context = selected_context
+            context_text_length = sum([item.length for item in current_context])
 
-            answer["context_length"] = context_text_length
+        return models, current_context, context_text_length
 
-            context.append(ContextItem(text=question, type="in", model=answer["model"]))
-            context.append(ContextItem(text=answer["text"], type="out", model=answer["model"]))
+    def _save(self, question, answer, context_text_length, tag=None):
 
-            # save the context per channel:user
-            Chat.context_manager.set_context(self._context_id, context) 
+        answer["context_length"] = context_text_length
 
-            return answer
+        context = Chat.context_manager.get_context(self._context_id)
+        context.append(ContextItem(text=question, type="in", model=answer["model"], tag=tag))
+        context.append(ContextItem(text=answer["text"], type="out", model=answer["model"], tag=tag))
 
-        except Exception as e:
-            raise e
+        # save the context per channel:user
+        Chat.context_manager.set_context(self._context_id, context) 
+
+        return answer
+
+    def ask(self, question, tag=None):
+        """
+        The question and the answer are added to the context with tag, see remove_tagged
+        """
+
+        models, current_context, context_text_length = self._prepare(question)
+
+        # send the question with the context to bedrock
+        answer = Chat.bedrock_client.call(models, current_context, context_text_length)
+
+        return self._save(question, answer, context_text_length, tag)
+
+    def ask_stream(self, question, tag=None, cancel=None):
+        """
+        The same as ask but yields the answer text as it is generated,
+        the last item is the answer dict that ask returns.
+        Closing it before the end stops the model and the question is not saved.
+        cancel, a threading.Event, does the same from another thread: it is checked
+        before the model is called, at every part and before the answer is saved.
+        """
+
+        if cancel is not None and cancel.is_set():
+            return
+
+        models, current_context, context_text_length = self._prepare(question)
+
+        stream = Chat.bedrock_client.call_stream(models, current_context, context_text_length)
+        try:
+            for part in stream:
+                if cancel is not None and cancel.is_set():
+                    return
+                if isinstance(part, dict):
+                    yield self._save(question, part, context_text_length, tag)
+                else:
+                    yield part
+        finally:
+            stream.close()
+
+    async def ask_async(self, question, tag=None):
+        """
+        The same as ask but awaits the model, for many chats in flight on one event loop
+        """
+
+        models, current_context, context_text_length = self._prepare(question)
+
+        answer = await Chat.bedrock_client.call_async(models, current_context, context_text_length)
+
+        return self._save(question, answer, context_text_length, tag)
     
+    def ask_many(self, questions, concurrency=8):
+        """
+        Asks each question on its own, without the context of this chat and without changing it,
+        concurrency at a time. Returns the answers in order with the total cost and throughput,
+        see Bedrock.call_batch.
+        """
+        models = Chat.context_manager.get_models(self._context_id)
+        contexts = [[ContextItem(text=question, type="in")] for question in questions]
+        return Chat.bedrock_client.call_batch(models, contexts, concurrency=concurrency)
+
     def get_context(self):
         """
         Returns a list of ContextItem objects
@@ -276,13 +1730,23 @@ class Chat():
     def context_length(self):
         return Chat.context_manager.context_length(self._context_id)
     
-    def add_to_context(self, text):
+    def add_to_context(self, text, tag=None):
         """
-        Adds additional text to the context such as content of a file
+        Adds additional text to the context such as content of a file,
+        tag such as the file's id finds it again for remove_tagged
         """
         text = text.strip()
         context = Chat.context_manager.get_context(self._context_id)
-        context.append(ContextItem(text, "in"))
+        context.append(Chat.context_manager.file_item(text, tag))
+        Chat.context_manager.set_context(self._context_id, context)
+
+    def add_files_to_context(self, files):
+        """
+        The same as add_to_context for a list of (text, tag), written once
+        """
+        context = Chat.context_manager.get_context(self._context_id)
+        for text, tag in files:
+            context.append(Chat.context_manager.file_item(text.strip(), tag))
         Chat.context_manager.set_context(self._context_id, context)
 
     def remove_from_context(self, count):
@@ -291,8 +1755,30 @@ class Chat():
         """
         Chat.context_manager.remove_from_context(self._context_id, count)
 
-    def list_models(self):
+    def remove_tagged(self, *tags):
+        """
+        Removes the items added with any of the tags, such as a file or a question and its answer,
+        from wherever they are in the context. Returns how many were removed.
+        """
+        return Chat.context_manager.remove_tagged(self._context_id, set(tags))
+
+    def cache_stats(self):
+        """
+        Returns the hit/miss counts of the answer cache or None if it is off
+        """
+        if Chat.bedrock_client.cache is None:
+            return None
+        return Chat.bedrock_client.cache.stats()
+
+    def list_models(self, with_stats=False):
+        """
+        Returns the model keys, cheapest first for the current context.
+        With with_stats, returns dicts with the key and the model's health:
+        circuit breaker state, calls, error rate and latency.
+        """
         models = Chat.context_manager.get_models(self._context_id)    
+        if with_stats:
+            return [{"key": model.key, **Chat.bedrock_client.health.stats(model.key)} for model in models]
         return [model.key for model in models]
 
     def set_model(self, model):
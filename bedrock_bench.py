@@ -0,0 +1,312 @@
+###############################################################
+# Benchmarks for the chat stack in bedrock.py
+#
+# python bedrock_bench.py startup
+# python bedrock_bench.py overhead --sizes 10,100,1000,10000
+# python bedrock_bench.py concurrency --contexts 100 --threads 16 --latency 0.05
+# python bedrock_bench.py lambda --calls 50
+#
+# overhead and concurrency use StubClient instead of bedrock-runtime,
+# lambda runs lambda_bedrock.lambda_handler against bedrock_stub.py,
+# add --output results.jsonl to keep the numbers
+###############################################################
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# each step is timed in a fresh interpreter, in a temporary directory so that no stored contexts are loaded
+STARTUP_STEPS = {
+    "import bedrock": "import bedrock",
+    "first Chat use": "import bedrock; bedrock.Chat('bench').list_models()",
+    "first client use": "import bedrock; bedrock.Chat('bench').list_models(); bedrock.Chat.bedrock_client._client",
+}
+
+class StubClient():
+
+    """
+    Stands in for the bedrock-runtime client: waits latency seconds
+    and reports about 4 characters per input token and out_tokens output tokens
+    """
+
+    def __init__(self, latency=0.0, out_tokens=100):
+        self.latency = latency
+        self.out_tokens = out_tokens
+
+    def _usage(self, messages):
+        in_tokens = sum([len(c.get("text", "")) for m in messages for c in m["content"]]) // 4
+        return {"inputTokens": in_tokens, "outputTokens": self.out_tokens, "totalTokens": in_tokens + self.out_tokens}
+
+    def converse(self, modelId, messages, **kwargs):
+        time.sleep(self.latency)
+        return {
+            "output": {"message": {"role": "assistant", "content": [{"text": f"{modelId} answers"}]}},
+            "stopReason": "end_turn",
+            "usage": self._usage(messages)}
+
+    def converse_stream(self, modelId, messages, **kwargs):
+        def stream():
+            for word in f"{modelId} answers".split(" "):
+                time.sleep(self.latency / 2)
+                yield {"contentBlockDelta": {"contentBlockIndex": 0, "delta": {"text": word + " "}}}
+            yield {"metadata": {"usage": self._usage(messages)}}
+        return {"stream": stream()}
+
+def _time_in_subprocess(code, cwd):
+    script = f"import sys, time; sys.path.insert(0, {HERE!r}); start = time.perf_counter(); {code}; print(time.perf_counter() - start)"
+    env = dict(os.environ)
+    env.setdefault("AWS_REGION", "us-east-1")
+    output = subprocess.run([sys.executable, "-c", script], cwd=cwd, env=env, capture_output=True, text=True, check=True)
+    return float(output.stdout.strip().splitlines()[-1])
+
+def startup(runs):
+    print(f"Startup, median of {runs} runs")
+    results = {}
+    with tempfile.TemporaryDirectory() as cwd:
+        for name, code in STARTUP_STEPS.items():
+            times = [_time_in_subprocess(code, cwd) for _ in range(runs)]
+            results[name] = statistics.median(times)
+            print(f"  {name:<20} {results[name] * 1000:8.1f} ms")
+    return results
+
+class LambdaContext():
+
+    """
+    The parts of the Lambda context object that lambda_handler uses
+    """
+
+    def __init__(self, request_id="bench", timeout=30):
+        self.aws_request_id = request_id
+        self._deadline = time.time() + timeout
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self._deadline - time.time()) * 1000))
+
+def _lambda_env(port):
+    env = dict(os.environ)
+    env.update({
+        "AWS_REGION": "us-east-1",
+        "AWS_DEFAULT_REGION": "us-east-1",
+        "AWS_ACCESS_KEY_ID": "stub",
+        "AWS_SECRET_ACCESS_KEY": "stub",
+        # honored by boto3 for every bedrock-runtime client
+        "AWS_ENDPOINT_URL_BEDROCK_RUNTIME": f"http://localhost:{port}"})
+    return env
+
+def lambda_start(runs, port, cwd, text_size):
+    """
+    A cold start in a fresh interpreter: the module import (the init phase) and the first invocation
+    """
+    env = _lambda_env(port)
+    inits, firsts = [], []
+    for i in range(runs):
+        # a new question each time, a new container has nothing cached
+        script = (
+            f"import json, sys, time; sys.path.insert(0, {HERE!r}); from bedrock_bench import LambdaContext; "
+            "start = time.perf_counter(); import lambda_bedrock; imported = time.perf_counter(); "
+            f"lambda_bedrock.lambda_handler({{'body': json.dumps({{'text': 'cold question {i} ' + 'x' * {text_size}}})}}, LambdaContext()); "
+            "print(imported - start, time.perf_counter() - imported)")
+        output = subprocess.run([sys.executable, "-c", script], cwd=cwd, env=env, capture_output=True, text=True, check=True)
+        init, first = output.stdout.strip().splitlines()[-1].split(" ")
+        inits.append(float(init))
+        firsts.append(float(first))
+    return _ms(inits), _ms(firsts)
+
+def lambda_handler(runs, calls, latency, text_size):
+    """
+    Cold and warm lambda_bedrock.lambda_handler invocations against the HTTP stub with latency.
+    Warm calls repeat one question, so with LAMBDA_CACHE_DIR set they are cache hits after the first.
+    """
+    import threading
+    import bedrock_stub
+
+    server = bedrock_stub.serve(0, latency)
+    port = server.server_address[1]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    with tempfile.TemporaryDirectory() as cwd:
+        init, first = lambda_start(runs, port, cwd, text_size)
+
+        os.environ.update(_lambda_env(port))
+        sys.path.insert(0, HERE)
+        import lambda_bedrock
+
+        event = {"body": json.dumps({"text": "warm question " + "x" * text_size})}
+        times = []
+        for i in range(calls):
+            start = time.perf_counter()
+            lambda_bedrock.lambda_handler(event, LambdaContext(f"bench-{i}"))
+            times.append(time.perf_counter() - start)
+    server.shutdown()
+
+    overheads = [t - latency for t in times]
+    results = {
+        "init_ms": init,
+        "first_call_ms": first,
+        "warm_p50_ms": _ms(times),
+        "warm_p95_ms": _p95(times),
+        "warm_p50_overhead_ms": _ms(overheads)}
+
+    print(f"lambda_bedrock, median of {runs} cold starts and {calls} warm calls, {text_size} character questions, {latency}s model latency")
+    print(f"  init (import)    {results['init_ms']:8.1f} ms")
+    print(f"  first call       {results['first_call_ms']:8.1f} ms")
+    print(f"  warm p50         {results['warm_p50_ms']:8.2f} ms, p95 {results['warm_p95_ms']:.2f} ms")
+    print(f"  warm overhead    {results['warm_p50_overhead_ms']:8.2f} ms")
+    return results
+
+def _stub_chat(latency, flush_interval):
+    """
+    Points bedrock.Chat to a StubClient, with no answer cache so that every ask calls it
+    """
+    import bedrock
+
+    os.environ["BEDROCK_CACHE_SIZE"] = "0"
+    client = bedrock.Bedrock()
+    client._sync_client = StubClient(latency=latency)
+    bedrock.Chat.bedrock_client = client
+    bedrock.Chat.context_manager = bedrock.Context(client, flush_interval=flush_interval)
+    return bedrock
+
+def _ms(times):
+    return statistics.median(times) * 1000
+
+def _p95(times):
+    return sorted(times)[int(len(times) * 0.95)] * 1000
+
+def overhead(sizes, asks, message_size, flush_interval):
+    """
+    Times the steps of Chat.ask around the model call as the history grows:
+    prepare (context, trimming, model order), the stub call, save (context update and writes)
+    """
+    bedrock = _stub_chat(0.0, flush_interval)
+
+    print(f"Overhead per ask, median of {asks} asks, {message_size} character messages, flush interval {flush_interval}s")
+    print(f"  {'history':>8} {'load':>9} {'prepare':>9} {'call':>9} {'save':>9} {'flush':>9} {'total':>9}")
+
+    results = {}
+    for size in sizes:
+        context_id = f"history-{size}"
+        chat = bedrock.Chat(context_id)
+        manager = bedrock.Chat.context_manager
+        manager.set_context(context_id, [
+            bedrock.ContextItem(text="x" * message_size, type="in" if i % 2 == 0 else "out") for i in range(size)])
+        manager.flush()
+
+        # loading the conversation in a fresh Context
+        start = time.perf_counter()
+        bedrock.Context(bedrock.Chat.bedrock_client, flush_interval=0).get_context(context_id)
+        load = time.perf_counter() - start
+
+        timings = {"prepare": [], "call": [], "save": [], "flush": [], "total": []}
+        for i in range(asks):
+            question = f"question {i} " + "q" * message_size
+
+            start = time.perf_counter()
+            models, current_context, context_text_length = chat._prepare(question)
+            prepared = time.perf_counter()
+            answer = bedrock.Chat.bedrock_client.call(models, current_context, context_text_length)
+            called = time.perf_counter()
+            chat._save(question, answer, context_text_length)
+            saved = time.perf_counter()
+            manager.flush()
+            flushed = time.perf_counter()
+
+            timings["prepare"].append(prepared - start)
+            timings["call"].append(called - prepared)
+            timings["save"].append(saved - called)
+            timings["flush"].append(flushed - saved)
+            timings["total"].append(flushed - start)
+
+        results[size] = {"load": load * 1000, **{name: _ms(times) for name, times in timings.items()}}
+        row = results[size]
+        print(f"  {size:>8} {row['load']:>7.2f}ms {row['prepare']:>7.2f}ms {row['call']:>7.2f}ms {row['save']:>7.2f}ms {row['flush']:>7.2f}ms {row['total']:>7.2f}ms")
+
+    return results
+
+def concurrency(contexts, threads, asks, latency, flush_interval):
+    """
+    Many conversations asking at once from a thread pool against a stub with latency
+    """
+    bedrock = _stub_chat(latency, flush_interval)
+
+    def ask(i):
+        start = time.perf_counter()
+        bedrock.Chat(f"user-{i % contexts}").ask(f"question {i}")
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        times = list(executor.map(ask, range(asks)))
+    elapsed = time.perf_counter() - start
+    bedrock.Chat.context_manager.flush()
+
+    overheads = [t - latency for t in times]
+    results = {
+        "asks_per_second": asks / elapsed,
+        "p50_ms": _ms(times),
+        "p95_ms": _p95(times),
+        "p50_overhead_ms": _ms(overheads),
+        "p95_overhead_ms": _p95(overheads)}
+
+    print(f"Concurrency, {asks} asks over {contexts} conversations on {threads} threads, {latency}s model latency")
+    print(f"  {results['asks_per_second']:.1f} asks/s")
+    print(f"  latency p50 {results['p50_ms']:.1f} ms, p95 {results['p95_ms']:.1f} ms")
+    print(f"  overhead p50 {results['p50_overhead_ms']:.2f} ms, p95 {results['p95_overhead_ms']:.2f} ms")
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", help="appends the results as a JSON line to this file")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    startup_parser = subparsers.add_parser("startup", help="time to import bedrock and to first use")
+    startup_parser.add_argument("--runs", type=int, default=5)
+
+    overhead_parser = subparsers.add_parser("overhead", help="time spent around the model call as history grows")
+    overhead_parser.add_argument("--sizes", default="10,100,1000,10000", help="history lengths in messages")
+    overhead_parser.add_argument("--asks", type=int, default=50)
+    overhead_parser.add_argument("--message-size", type=int, default=20, help="characters per message")
+    overhead_parser.add_argument("--flush-interval", type=float, default=0, help="0 writes on every ask")
+
+    concurrency_parser = subparsers.add_parser("concurrency", help="throughput with many conversations at once")
+    concurrency_parser.add_argument("--contexts", type=int, default=100)
+    concurrency_parser.add_argument("--threads", type=int, default=16)
+    concurrency_parser.add_argument("--asks", type=int, default=1000)
+    concurrency_parser.add_argument("--latency", type=float, default=0.05, help="seconds per model call")
+    concurrency_parser.add_argument("--flush-interval", type=float, default=1)
+
+    lambda_parser = subparsers.add_parser("lambda", help="cold start and warm calls of lambda_bedrock")
+    lambda_parser.add_argument("--runs", type=int, default=5, help="cold starts")
+    lambda_parser.add_argument("--calls", type=int, default=50, help="warm calls")
+    lambda_parser.add_argument("--latency", type=float, default=0.0, help="seconds per model call")
+    lambda_parser.add_argument("--text-size", type=int, default=1000, help="characters per question")
+
+    args = parser.parse_args()
+
+    if args.benchmark == "startup":
+        results = startup(args.runs)
+    elif args.benchmark == "lambda":
+        results = lambda_handler(args.runs, args.calls, args.latency, args.text_size)
+    else:
+        # contexts.db and models.pkl are written to the working directory
+        with tempfile.TemporaryDirectory() as cwd:
+            os.chdir(cwd)
+            if args.benchmark == "overhead":
+                results = overhead([int(size) for size in args.sizes.split(",")], args.asks, args.message_size, args.flush_interval)
+            else:
+                results = concurrency(args.contexts, args.threads, args.asks, args.latency, args.flush_interval)
+            os.chdir(HERE)
+
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(json.dumps({"benchmark": args.benchmark, "time": datetime.now().isoformat(), "args": vars(args), "results": results}) + "\n")
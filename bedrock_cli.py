@@ -1,10 +1,53 @@
 import cmd2
-import glob
+import fnmatch
+import hashlib
 import os
 import sys
+import time
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
 import bedrock
 
+# ftc skips directories and files matching these, BEDROCK_FTC_IGNORE adds comma separated patterns
+IGNORE_PATTERNS = [".git", ".hg", ".svn", "node_modules", "__pycache__", ".venv", "venv", ".mypy_cache", ".pytest_cache", ".idea", ".DS_Store", "*.pyc"]
+# larger files are skipped
+MAX_FILE_BYTES = int(os.environ.get("BEDROCK_FTC_MAX_FILE_BYTES", 1024 * 1024))
+READ_WORKERS = 16
+
+def find_files(path, extensions, patterns):
+    """
+    Returns the absolute paths of the files under path with one of the extensions (all if None),
+    ignored directories are not walked into
+    """
+    if os.path.isfile(path):
+        return [os.path.abspath(path)]
+    found = []
+    for root, dirs, files in os.walk(path):
+        dirs[:] = [d for d in dirs if not any(fnmatch.fnmatch(d, p) for p in patterns)]
+        for name in files:
+            if any(fnmatch.fnmatch(name, p) for p in patterns):
+                continue
+            if extensions and os.path.splitext(name)[1][1:] not in extensions:
+                continue
+            found.append(os.path.abspath(os.path.join(root, name)))
+    return found
+
+def read_file(path):
+    """
+    Returns the text and the hash of a file, or None and why it is skipped
+    """
+    try:
+        with open(path, "rb") as f:
+            data = f.read(MAX_FILE_BYTES + 1)
+    except OSError:
+        return None, "unreadable"
+    text, why = bedrock.decode_text([data], MAX_FILE_BYTES)
+    if text is None:
+        return None, why
+    return text, hashlib.sha256(data).hexdigest()
+
 
 class Shell(cmd2.Cmd):
 
@@ -13,7 +56,8 @@ class Shell(cmd2.Cmd):
 
     def __init__(self):
         super().__init__()
-        self.chat = bedrock.Chat("local")
+        self.context_id = "local"
+        self.chat = bedrock.Chat(self.context_id)
     
     def do_a(self, arg):
         self.do_ask(arg)
@@ -23,16 +67,18 @@ class Shell(cmd2.Cmd):
         arg = arg.args
 
         try:
-        
-            answer = self.chat.ask(arg)
 
             print()
 
-            text = answer["text"]
-            lines = text.split("\n")
-            for line in lines:
-                print(line)
+            # print the answer as it is generated
+            for part in self.chat.ask_stream(arg):
+                if isinstance(part, dict):
+                    answer = part
+                else:
+                    sys.stdout.write(part)
+                    sys.stdout.flush()
 
+            print()
             print()
             print(f"Context length: {answer['context_length']}")
             print(f"Model: {answer['model']}")
@@ -81,8 +127,11 @@ class Shell(cmd2.Cmd):
         self.do_list_models(arg)
 
     def do_list_models(self, arg):
-        models = self.chat.list_models()    
-        print(f"Using {models[0]}. You can use one of {[model for model in models]}")
+        models = self.chat.list_models(with_stats=True)
+        print(f"Using {models[0]['key']}. You can use one of {[model['key'] for model in models]}")
+        for model in models:
+            latency = f"{model['avg_latency']:.1f}s" if model["avg_latency"] is not None else "n/a"
+            print(f"  {model['key']}: {model['state']}, {model['calls']} calls, {model['error_rate']:.0%} errors, {latency} average")
 
     def do_sm(self, arg):
         self.do_set_model(arg)
@@ -106,38 +155,75 @@ class Shell(cmd2.Cmd):
         self.do_file_to_context(arg)
 
     def do_file_to_context(self, arg):
+        """
+        Adds the files that are not in the context yet or changed since, read in parallel.
+        Each file is tagged with its path, a changed file replaces its previous version.
+        Size and mtime from the last ftc tell which files changed without reading them.
+        """
         arg = arg.args
 
         args = arg.split(" ")
         path = args[0]
         types = args[1] if len(args) > 1 else None
 
-        current_context = self.chat.get_context()
-        if os.path.isfile(path):
-            with open(path, "r") as f:
-                lines = f.read()
-                current_context.append(bedrock.ContextItem(text=lines, type="in"))
-                self.chat.set_context(current_context)
-        elif os.path.isdir(path):
-            pattern = "*"
-            if types:
-                _types = types.split(",")
-                if len(_types) == 1:
-                    pattern = f"*.{_types[0]}"
-                else:
-                    pattern = f"*.{{types}}"
-
-            file_paths = glob.glob(path + f"/**/{pattern}", recursive=True)
-            for file_path in file_paths:
-                if os.path.isfile(file_path):
-                    
-                    with open(file_path, "r") as f:
-                        lines = f.read()
-                        current_context.append(bedrock.ContextItem(text=lines, type="in"))            
-
-            self.chat.set_context(current_context)
-        else:
+        if not os.path.exists(path):
             print(f"File {path} not found")
+            return
+
+        start = time.time()
+        extensions = set(types.split(",")) if types else None
+        patterns = IGNORE_PATTERNS + [p for p in os.environ.get("BEDROCK_FTC_IGNORE", "").split(",") if p]
+        file_paths = find_files(path, extensions, patterns)
+
+        store = bedrock.Chat.context_manager.store
+        manifest = store.load_manifest(self.context_id)
+        # a file in the manifest may have been cleared or trimmed from the context since
+        present = {item.tag for item in self.chat.get_context() if item.tag}
+
+        skipped = Counter()
+        to_read = []
+        for file_path in file_paths:
+            stat = os.stat(file_path)
+            known = manifest.get(file_path)
+            if f"file:{file_path}" in present and known and known[0] == stat.st_mtime and known[1] == stat.st_size:
+                skipped["unchanged"] += 1
+            elif stat.st_size > MAX_FILE_BYTES:
+                skipped["too large"] += 1
+            else:
+                to_read.append((file_path, stat))
+
+        with ThreadPoolExecutor(max_workers=READ_WORKERS) as executor:
+            results = list(executor.map(lambda f: read_file(f[0]), to_read))
+
+        files = []
+        replaced = []
+        read_files = []
+        read_bytes = 0
+        for (file_path, stat), (text, hash) in zip(to_read, results):
+            if text is None:
+                skipped[hash] += 1
+                continue
+            read_bytes += stat.st_size
+            read_files.append((file_path, stat.st_mtime, stat.st_size, hash))
+            tag = f"file:{file_path}"
+            if tag in present:
+                if manifest.get(file_path, (None, None, None))[2] == hash:
+                    # touched but the same
+                    skipped["unchanged"] += 1
+                    continue
+                replaced.append(tag)
+            files.append((text, tag))
+
+        if replaced:
+            self.chat.remove_tagged(*replaced)
+        if files:
+            self.chat.add_files_to_context(files)
+        store.put_manifest(self.context_id, read_files)
+
+        elapsed = time.time() - start
+        print(f"Added {len(files) - len(replaced)} files, updated {len(replaced)} in {elapsed:.2f}s ({read_bytes / 1000000 / max(elapsed, 0.001):.1f} MB/s)")
+        if skipped:
+            print("Skipped " + ", ".join([f"{count} {reason}" for reason, count in skipped.items()]))
 
     def do_q(self, arg):
         return self.do_quit(arg)
@@ -155,7 +241,7 @@ class Shell(cmd2.Cmd):
         lm  # lists models
         sm {model} # sets model
         rm  # reset model to cheapest given the current context
-        ftc {path} {extention:options} # adds a file or files in a directory to the context
+        ftc {path} {extention:options} # adds a file or the files in a directory to the context, again only the changed ones
             ftc /full/path/to/file.txt
             ftc /full/path/to/directory
             ftc /full/path/to/directory yaml
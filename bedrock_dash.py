@@ -1,6 +1,6 @@
 import argparse
 import dash
-from dash import dcc, html, Input, Output, State, clientside_callback, callback, no_update, ALL, ctx
+from dash import dcc, html, Input, Output, State, clientside_callback, callback, no_update, ALL, ctx, Patch
 from dash_iconify import DashIconify
 import dash_bootstrap_components as dbc # Import Bootstrap components
 import copy  # Needed to copy style dictionaries
@@ -11,6 +11,9 @@ import zipfile # To handle zip files
 import io # To handle zip files in memory
 import base64 # To decode upload content
 import os # To check file extensions
+import threading # To answer in the background
+import time # To drop finished answers nobody polled
+from concurrent.futures import ThreadPoolExecutor # To decode zip members in parallel and to answer in the background
 
 import bedrock
 
@@ -46,7 +49,153 @@ summary_max_length = 80 # Max characters for previous chat summary
 ALLOWED_EXTENSIONS = {'.txt', '.yaml', '.sql', '.py', '.md'}
 ALLOWED_EXTENSIONS_UPLOAD = ALLOWED_EXTENSIONS.union({'.zip'}) # Add .zip for upload component
 
+# Upload limits: larger files, binary files and files past the total of one upload are skipped
+max_file_bytes = 2 * 1024 * 1024
+max_upload_bytes = 50 * 1024 * 1024
+decode_chunk_bytes = 64 * 1024
+decode_workers = 8 # zip members decompressed at once
+
+# Answers are generated in the background, the browser polls for the partial text
+ask_workers = 16 # answers generated at once
+ask_poll_ms = 500
+ask_job_ttl = 600 # seconds a finished answer waits to be polled
+staged_file_ttl = 3600 # seconds an uploaded file waits for its message to be sent
+
 # --- Helper Function ---
+def history_store():
+    """
+    Chat histories are kept server-side next to the chat contexts,
+    the browser only has chat ids, summaries and history lengths
+    """
+    return bedrock.Chat.context_manager.store
+
+def decode_text(stream, limit=max_file_bytes):
+    """Reads a binary stream as UTF-8 chunk by chunk, None when it is binary or larger than limit."""
+    text, _ = bedrock.decode_text(iter(lambda: stream.read(decode_chunk_bytes), b''), limit)
+    return text
+
+def zip_texts(name, data, staged, budget):
+    """
+    Returns (qualified name, text or None) for the allowed members of a zip that are not staged yet,
+    decoded in parallel, and the bytes used of budget. Members over the limits are skipped before they are read.
+    """
+    with zipfile.ZipFile(io.BytesIO(data), 'r') as zip_ref:
+        members = []
+        used = 0
+        for info in zip_ref.infolist():
+            member_name = info.filename
+            if info.is_dir() or member_name.startswith('__MACOSX/') or os.path.basename(member_name).startswith('.'):
+                continue
+            _, ext = os.path.splitext(member_name)
+            qualified_name = f"{name}/{member_name}"
+            if ext.lower() not in ALLOWED_EXTENSIONS or qualified_name in staged:
+                continue
+            if info.file_size > max_file_bytes or used + info.file_size > budget:
+                continue
+            used += info.file_size
+            members.append((qualified_name, info))
+
+        def read(member):
+            # an encrypted member, an unsupported compression method or a bad CRC skips only that member
+            try:
+                with zip_ref.open(member[1]) as f:
+                    return decode_text(f)
+            except Exception as e:
+                print(f"Skipping '{member[0]}': {e}")
+                return None
+
+        with ThreadPoolExecutor(max_workers=decode_workers) as executor:
+            texts = list(executor.map(read, members))
+    return [(qualified_name, text) for (qualified_name, _), text in zip(members, texts)], used
+
+# --- Staged files ---
+# the texts of uploaded files wait here until their message is sent, so that files never sent are not stored
+staged_texts = {}
+staged_texts_lock = threading.Lock()
+
+def stage_text(file_id, text):
+    with staged_texts_lock:
+        # files whose message was never sent
+        for old_id in [i for i, (staged, _) in staged_texts.items() if time.time() - staged > staged_file_ttl]:
+            del staged_texts[old_id]
+        staged_texts[file_id] = (time.time(), text)
+
+def take_staged_text(file_id):
+    """Returns the text of a staged file and forgets it, None when it is not staged."""
+    with staged_texts_lock:
+        staged = staged_texts.pop(file_id, None)
+    return staged[1] if staged else None
+
+# --- Background answers ---
+ask_executor = ThreadPoolExecutor(max_workers=ask_workers)
+ask_jobs = {}
+ask_jobs_lock = threading.Lock()
+
+def message_tags(entry):
+    """
+    The tags of the context items of a history entry: its question and answer and its files.
+    Entries saved before items were tagged have none.
+    """
+    tags = [f"file:{a['id']}" for a in entry.get('attachments', [])]
+    if entry.get('id'):
+        tags.append(f"msg:{entry['id']}")
+    return tags
+
+def run_ask(job, chat_id, entry, index):
+    """
+    Streams the answer into the job, stops the model when the job is cancelled,
+    saves the finished entry to the history at index, or at the end when index is None.
+    """
+    question = entry['text']
+    try:
+        _chat = bedrock.Chat(chat_id)
+        answer = None
+        for part in _chat.ask_stream(question, tag=f"msg:{entry['id']}", cancel=job['cancel']):
+            if isinstance(part, dict):
+                answer = part
+            else:
+                job['parts'].append(part)
+        if job['cancel'].is_set():
+            if answer is not None:
+                # cancelled after the question and the answer were added to the context
+                _chat.remove_tagged(f"msg:{entry['id']}")
+            print(f"Cancelled answer to: {question}")
+            return
+        answer_text = answer["text"]
+        if entry['files']: answer_text += f" (Files: {', '.join(entry['files'])})"
+        new_entry = {
+            **entry,
+            'answer': answer_text,
+            'cost': answer["cost"],
+            'time': answer["time"],
+            'model': answer["model"],
+            'context_length': _chat.context_length(),
+            'stale': False,
+            }
+        store = history_store()
+        job['length'] = store.put_history(chat_id, store.history_length(chat_id) if index is None else index, new_entry)
+    except Exception as e:
+        print(f"Error answering '{question}': {e}")
+        job['error'] = str(e)
+    finally:
+        job['finished'] = time.time()
+
+def start_ask(chat_id, entry, index=None):
+    """
+    Starts answering the question of a history entry in the background and returns the job id.
+    With index, the answer replaces that entry instead of being appended.
+    """
+    job_id = str(uuid.uuid4())
+    job = {'parts': [], 'cancel': threading.Event(), 'length': None, 'error': None, 'finished': None,
+           'op': 'append' if index is None else 'update'}
+    with ask_jobs_lock:
+        # answers whose browser went away
+        for old_id in [i for i, j in ask_jobs.items() if j['finished'] and time.time() - j['finished'] > ask_job_ttl]:
+            del ask_jobs[old_id]
+        ask_jobs[job_id] = job
+    ask_executor.submit(run_ask, job, chat_id, entry, index)
+    return job_id
+
 def get_summary(text, max_len=summary_max_length):
     """Extracts the first sentence or a truncated summary from text."""
     if not text:
@@ -114,6 +263,13 @@ message_files_style = {'marginLeft': 'calc(1.8em + 0.6em)', 'marginTop': '0.3em'
 message_filename_style = {'fontSize': '0.85em', 'color': '#555', 'backgroundColor': '#eee', 'padding': '1px 5px', 'borderRadius': '3px', 'border': '1px solid #ddd'}
 deletable_file_item_style = {'display': 'inline-flex', 'alignItems': 'center', 'border': '1px solid #ccc', 'borderRadius': '4px', 'padding': '1px 2px 1px 5px', 'margin': '0', 'fontSize': '0.85em', 'color': '#333', 'backgroundColor': '#f0f0f0'}
 deletable_filename_text_style = {'paddingRight': '0.5ch'}
+streaming_container_style = {'display': 'block'}
+streaming_container_hidden_style = {'display': 'none'}
+# switching chats stops showing the answer being generated, run_ask still saves it to its own chat:
+# no job, polling off, no partial answer, hidden, no error
+hidden_answer = (None, True, [], streaming_container_hidden_style, [])
+ask_error_style = {'color': '#b00020', 'fontSize': '0.9em', 'marginLeft': 'calc(1.8em + 0.6em)', 'marginBottom': '0.5em', 'whiteSpace': 'pre-wrap'}
+cancel_ask_button_style = {'border': '1px solid #ccc', 'borderRadius': '4px', 'background': 'none', 'color': '#555', 'fontSize': '0.85em', 'padding': '2px 8px', 'cursor': 'pointer', 'marginLeft': 'calc(1.8em + 0.6em)'}
 model_display_style = {
     'position': 'absolute', # Position relative to the answer box
     'bottom': '5px',        # Position it near the bottom
@@ -123,6 +279,8 @@ model_display_style = {
     'textAlign': 'left'
 }
 
+model_options = models()
+
 # --- Define App Layout ---
 # (Layout remains unchanged)
 app.layout = html.Div( # Outermost container
@@ -130,11 +288,16 @@ app.layout = html.Div( # Outermost container
 
         dcc.Store(id='side-panel-state-store', data={'isOpen': False}),
         dcc.Store(id='uploaded-files-store', data=[]),
-        dcc.Store(id='message-history-store', data=[]),
+        # the history itself is in history_store(), op tells render_message_history what changed:
+        # 'append' a message, 'pop' the last message, 'update' the last message, 'load' all,
+        # chat_id, when set, is the chat it belongs to
+        dcc.Store(id='message-history-store', data={'length': 0, 'op': 'load'}),
         dcc.Store(id='previous-chats-store', data=[], storage_type='local'),
         dcc.Store(id='current-chat-id-store', data=None),
+        dcc.Store(id='ask-job-store', data=None), # the answer being generated: job id, chat id, question and files
+        dcc.Interval(id='ask-poll-interval', interval=ask_poll_ms, disabled=True),
         dcc.Store(id='editing-summary-state-store', data={'editing_chat_id': None}),
-        dcc.Store(id='current-selected-model-store', data=models()[0]['value']), # Store for selected model value
+        dcc.Store(id='current-selected-model-store', data=model_options[0]['value']), # Store for selected model value
         html.Div(id='dummy-output', style={'display': 'none'}),
         html.Div( # Main Flex Container (Panel + Chat)
             [
@@ -159,7 +322,15 @@ app.layout = html.Div( # Outermost container
                     [
                         html.Div( # Inner container for chat interface
                            [
-                                html.Div(id='submitted-text-display', style=submitted_display_style, children=[]),
+                                html.Div(id='submitted-text-display', style=submitted_display_style, children=[
+                                    html.Div(id='history-past', children=[]), # messages before the last, only appended to
+                                    html.Div(id='history-last', children=[]), # the last message, with its edit and delete buttons
+                                    html.Div([ # the message being answered
+                                        html.Div(id='streaming-message', children=[]),
+                                        html.Button("Stop", id='cancel-ask-button', style=cancel_ask_button_style, n_clicks=0, title="Stop answering"),
+                                    ], id='history-streaming', style=streaming_container_hidden_style),
+                                    html.Div(id='ask-error', children=[], style=ask_error_style), # why the last question was not answered
+                                ]),
                                 html.Div([ # Input area wrapper
                                     dcc.Textarea(id='my-textarea', value='', style={'width': '100%', 'minHeight': f'{initial_height_px}px', 'maxHeight': f'{max_height_px}px', 'borderRadius': '10px', 'padding': '1ch', 'border': '1px solid #ccc', 'display': 'block', 'lineHeight': '1.5', 'resize': 'none', 'overflowY': 'auto'}, placeholder='Ask me something'),
                                     html.Div(id='filename-row', children=[], style=filename_row_style_hidden),
@@ -168,13 +339,13 @@ app.layout = html.Div( # Outermost container
                                         html.Div(style={'flexGrow': 1}), # Spacer
                                         dbc.DropdownMenu(
                                             id='model-select-dropdown-button', # ID for the button part to update label
-                                            label=models()[0]['value'], # Initial label
+                                            label=model_options[0]['value'], # Initial label
                                             children=[
                                                 dbc.DropdownMenuItem(
                                                     item['label'],
                                                     id={'type': 'model-select-item', 'value': item['value']},
                                                     n_clicks=0 # Needed for input trigger
-                                                ) for item in models()
+                                                ) for item in model_options
                                             ],
                                             direction="up", # Open upwards
                                             color="secondary", # Example color, adjust as needed
@@ -230,17 +401,22 @@ def toggle_side_panel(n_clicks, current_state):
     Output('side-panel', 'style', allow_duplicate=True),
     Output('side-panel-content', 'style', allow_duplicate=True),
     Output('panel-toggle-button', 'children', allow_duplicate=True),
+    Output('ask-job-store', 'data', allow_duplicate=True),
+    Output('ask-poll-interval', 'disabled', allow_duplicate=True),
+    Output('streaming-message', 'children', allow_duplicate=True),
+    Output('history-streaming', 'style', allow_duplicate=True),
+    Output('ask-error', 'children', allow_duplicate=True),
     Input('new-chat-button', 'n_clicks'),
     prevent_initial_call='initial_duplicate'
 )
 def start_new_chat(n_clicks):
     # ... (code unchanged) ...
     if n_clicks is None or n_clicks < 1:
-        return (no_update,) * 8
+        return (no_update,) * 13
     print("\n--- Start New Chat Callback Triggered ---")
     new_chat_id = str(uuid.uuid4())
     print(f"Generated New Chat ID: {new_chat_id}")
-    cleared_history = []
+    cleared_history = {'length': 0, 'op': 'load', 'chat_id': new_chat_id}
     cleared_textarea = ""
     cleared_files = []
     closed_panel_state = {'isOpen': False}
@@ -249,7 +425,8 @@ def start_new_chat(n_clicks):
     closed_toggle_icon = DashIconify(icon="mdi:menu", width=24)
     return (
         cleared_history, cleared_textarea, cleared_files, new_chat_id,
-        closed_panel_state, closed_panel_style_val, closed_content_style_val, closed_toggle_icon
+        closed_panel_state, closed_panel_style_val, closed_content_style_val, closed_toggle_icon,
+        *hidden_answer
     )
 
 # ** Callback: Render Previous Chats List **
@@ -287,85 +464,53 @@ def render_previous_chats(previous_chats_data, editing_state):
     Output('my-textarea', 'value', allow_duplicate=True),
     Output('uploaded-files-store', 'data', allow_duplicate=True),
     Output('current-chat-id-store', 'data', allow_duplicate=True),
-    Output('previous-chats-store', 'data', allow_duplicate=True), # Add output back
+    Output('previous-chats-store', 'data', allow_duplicate=True),
     Output('side-panel-state-store', 'data', allow_duplicate=True),
     Output('side-panel', 'style', allow_duplicate=True),
     Output('side-panel-content', 'style', allow_duplicate=True),
     Output('panel-toggle-button', 'children', allow_duplicate=True),
+    Output('ask-job-store', 'data', allow_duplicate=True),
+    Output('ask-poll-interval', 'disabled', allow_duplicate=True),
+    Output('streaming-message', 'children', allow_duplicate=True),
+    Output('history-streaming', 'style', allow_duplicate=True),
+    Output('ask-error', 'children', allow_duplicate=True),
     Input({'type': 'load-chat-button', 'chat_id': ALL}, 'n_clicks'),
     State('previous-chats-store', 'data'),
-    State('message-history-store', 'data'), # Add state back
-    State('current-chat-id-store', 'data'), # Add state back
     prevent_initial_call='initial_duplicate'
 )
-def load_previous_chat(n_clicks, previous_chats_list, current_chat_history, 
-                       current_chat_id):
-    # ... (code unchanged - already moves loaded chat to top) ...
+def load_previous_chat(n_clicks, previous_chats_list):
     triggered = ctx.triggered_id
     if not triggered or not isinstance(triggered, dict) or triggered.get('type') != 'load-chat-button' or not any(n > 0 for n in n_clicks if n is not None):
-        return (no_update,) * 9
+        return (no_update,) * 14
     chat_id_to_load = triggered['chat_id']
     print(f"\n--- Load Previous Chat Callback Triggered (ID: {chat_id_to_load}) ---")
-    if not previous_chats_list: previous_chats_list = []
-    updated_previous_chats = list(previous_chats_list)
-    current_chat_entry = None
-    found_index_for_current = -1
-    if current_chat_history and current_chat_id:
-        try:
-            first_message = current_chat_history[0]
-            first_question_text = first_message.get('text', '')
-            current_summary = get_summary(first_question_text)
-            current_chat_entry = {'id': current_chat_id, 'summary': current_summary, 'history': current_chat_history}
-            print(f"Attempting to save current chat (ID: {current_chat_id}), summary: {current_summary}")
-            for i, chat in enumerate(updated_previous_chats):
-                if chat.get('id') == current_chat_id:
-                    found_index_for_current = i
-                    break
-            if found_index_for_current != -1:
-                 updated_previous_chats[found_index_for_current] = current_chat_entry
-                 print(f"Updated existing entry for current chat at index {found_index_for_current}.")
-            # else: # Don't insert here, handle after moving loaded chat
-        except Exception as e:
-            print(f"Error during current chat saving logic in load_previous_chat: {e}")
-            updated_previous_chats = no_update
-    else:
-        print("Current chat history or ID is empty/None, nothing to save.")
-    history_to_load = None
-    summary_loaded = "Not Found"
-    chat_to_move = None
-    index_to_load = -1
-    if isinstance(updated_previous_chats, list):
-        for i, chat_entry in enumerate(updated_previous_chats):
-            if chat_entry.get('id') == chat_id_to_load:
-                index_to_load = i
-                break
-        if index_to_load != -1:
-            chat_to_move = updated_previous_chats.pop(index_to_load)
-            history_to_load = chat_to_move.get('history', [])
-            summary_loaded = chat_to_move.get('summary', 'N/A')
-            if current_chat_entry and found_index_for_current == -1:
-                 updated_previous_chats.insert(0, current_chat_entry)
-                 print("Inserted current chat as new entry at index 0.")
-            updated_previous_chats.insert(0, chat_to_move)
-            print(f"Moved loaded chat '{summary_loaded}' to top.")
-        else:
-             print(f"Error: Chat with ID {chat_id_to_load} not found after potential save.")
-             updated_previous_chats = no_update
-             if history_to_load is None: return (no_update,) * 9
-    else:
-        print("Skipping loading because previous chats list wasn't updated due to error.")
-        return (no_update,) * 9
+    updated_previous_chats = list(previous_chats_list or [])
+    index_to_load = next((i for i, chat in enumerate(updated_previous_chats) if chat.get('id') == chat_id_to_load), -1)
+    if index_to_load == -1:
+        print(f"Error: Chat with ID {chat_id_to_load} not found.")
+        return (no_update,) * 14
+    chat_to_move = updated_previous_chats.pop(index_to_load)
+    store = history_store()
+    if 'history' in chat_to_move:
+        # chats saved before histories were kept server-side carry their history, it is moved to the store once
+        if store.history_length(chat_id_to_load) == 0:
+            for i, entry in enumerate(chat_to_move['history']):
+                store.put_history(chat_id_to_load, i, entry)
+        chat_to_move = {'id': chat_id_to_load, 'summary': chat_to_move.get('summary', 'N/A')}
+    updated_previous_chats.insert(0, chat_to_move)
+    print(f"Moved loaded chat '{chat_to_move.get('summary', 'N/A')}' to top.")
+    history_to_load = {'length': store.history_length(chat_id_to_load), 'op': 'load', 'chat_id': chat_id_to_load}
     cleared_textarea = ""
     cleared_files = []
     closed_panel_state = {'isOpen': False}
     closed_panel_style_val = side_panel_closed_style
     closed_content_style_val = side_panel_content_closed_style
     closed_toggle_icon = DashIconify(icon="mdi:menu", width=24)
-    print(f"Final Previous Chats List (Load - to be returned): {[chat.get('summary', 'ERR') for chat in updated_previous_chats if isinstance(updated_previous_chats, list)]}")
     return (
         history_to_load, cleared_textarea, cleared_files, chat_id_to_load,
         updated_previous_chats, # Return the reordered list
-        closed_panel_state, closed_panel_style_val, closed_content_style_val, closed_toggle_icon
+        closed_panel_state, closed_panel_style_val, closed_content_style_val, closed_toggle_icon,
+        *hidden_answer
     )
 
 
@@ -390,6 +535,7 @@ def delete_previous_chat(n_clicks, previous_chats_list):
         return no_update
     
     _chat = bedrock.Chat(chat_id_to_delete).clear_context()
+    history_store().truncate_history(chat_id_to_delete)
 
     print(f"Deleted chat with ID: {chat_id_to_delete}")
     return updated_previous_chats
@@ -492,82 +638,75 @@ def save_summary_edit(save_n_clicks, input_n_submit, input_values, input_ids, pr
 def handle_uploads(list_of_contents, list_of_names, current_files):
     """
     Adds newly uploaded files to the temporary store.
-    If a zip file is uploaded, extracts filenames with allowed extensions.
+    If a zip file is uploaded, extracts the files with allowed extensions.
+    File texts are kept by stage_text until the message is sent, the browser only gets filenames and ids.
     """
     print("\n--- handle_uploads triggered ---") # DEBUG
     print(f"Input filenames: {list_of_names}") # DEBUG
-    print(f"Current files in store (state): {current_files}") # DEBUG
 
     if list_of_contents is None or list_of_names is None:
         print("handle_uploads: No contents or names provided.") # DEBUG
         return no_update
 
-    if current_files is None:
-        current_files = []
+    updated_files_list = list(current_files or [])
+    # filenames already staged and added in this batch
+    staged = {f['filename'] for f in updated_files_list}
+    budget = max_upload_bytes
+    skipped = 0
 
-    updated_files_list = copy.deepcopy(current_files)
-    # Get filenames already in the list *before* this batch
-    current_filenames_in_store = {f['filename'] for f in updated_files_list}
-    files_added_this_run = 0
+    def stage(filename, text):
+        file_id = str(uuid.uuid4())
+        stage_text(file_id, text)
+        updated_files_list.append({'filename': filename, 'id': file_id})
+        staged.add(filename)
 
     for content, name in zip(list_of_contents, list_of_names):
         if name is None or content is None:
             continue
 
-        content_type, content_string = content.split(',')
+        _, ext = os.path.splitext(name)
+        if ext.lower() not in ALLOWED_EXTENSIONS_UPLOAD:
+            print(f"Skipping file with disallowed extension: {name}") # DEBUG
+            continue
+        if name in staged:
+            print(f"Skipping duplicate file: {name}") # DEBUG
+            continue
 
-        file_lower = name.lower()
-        # Check if it's a zip file
-        if file_lower.endswith('.zip'):
-            try:
-                decoded = base64.b64decode(content_string)
-                zip_str = io.BytesIO(decoded)
-
-                with zipfile.ZipFile(zip_str, 'r') as zip_ref:
-                    for member_name in zip_ref.namelist():
-                        if member_name.endswith('/') or member_name.startswith('__MACOSX/') or os.path.basename(member_name).startswith('.'):
-                            continue
-                        _, ext = os.path.splitext(member_name)
-                        if ext.lower() in ALLOWED_EXTENSIONS:
-                            qualified_name = f"{name}/{member_name}"
-                            # Check against files already present (before this batch + added in this batch)
-                            if not any(f['filename'] == qualified_name for f in updated_files_list):
-                                file_id = str(uuid.uuid4())
-
-                                bytes = zip_ref.read(member_name)
-                                text = bytes.decode('utf-8', errors='ignore')
-
-                                updated_files_list.append({'filename': qualified_name, 'id': file_id, "content": text})
-                                files_added_this_run += 1
-                                print(f"Staged from zip: {qualified_name}")
-                            else:
-                                 print(f"Skipping duplicate file from zip: {qualified_name}") # DEBUG
-
-            except zipfile.BadZipFile: print(f"Error: Uploaded file '{name}' is not a valid zip file.")
-            except Exception as e: print(f"Error processing zip file '{name}': {e}")
+        content_type, content_string = content.split(',', 1)
+        # base64 is 4 characters per 3 bytes, checked before decoding
+        if len(content_string) * 3 // 4 > (budget if ext.lower() == '.zip' else min(budget, max_file_bytes)):
+            print(f"Skipping file over the size limit: {name}")
+            skipped += 1
+            continue
+        data = base64.b64decode(content_string)
 
+        if ext.lower() == '.zip':
+            try:
+                texts, used = zip_texts(name, data, staged, budget)
+            except zipfile.BadZipFile:
+                print(f"Error: Uploaded file '{name}' is not a valid zip file.")
+                continue
+            except Exception as e:
+                print(f"Error processing zip file '{name}': {e}")
+                continue
+            budget -= used
+            for qualified_name, text in texts:
+                if text is None:
+                    skipped += 1
+                else:
+                    stage(qualified_name, text)
+            print(f"Staged {sum(1 for _, text in texts if text is not None)} files from zip: {name}")
         else:
-            # Handle regular file uploads
-             _, ext = os.path.splitext(name)
-             if ext.lower() in ALLOWED_EXTENSIONS_UPLOAD:
-                 # Check against files already present (before this batch + added in this batch)
-                 if not any(f['filename'] == name for f in updated_files_list):
-                    file_id = str(uuid.uuid4())
-                
-                    decoded_bytes = base64.b64decode(content_string)
-                    decoded_string = decoded_bytes.decode('utf-8', errors='replace')
-
-                    updated_files_list.append({'filename': name, 'id': file_id, "content": decoded_string})
-                    files_added_this_run += 1
-                    print(f"Staged file: {name}")
-
-                 else:
-                     print(f"Skipping duplicate file: {name}") # DEBUG
-             else:
-                 print(f"Skipping file with disallowed extension: {name}") # DEBUG
-
-    print(f"Files added in this run: {files_added_this_run}") # DEBUG
-    print(f"Returning updated file list: {updated_files_list}") # DEBUG
+            text = decode_text(io.BytesIO(data))
+            if text is None:
+                print(f"Skipping binary file: {name}")
+                skipped += 1
+                continue
+            budget -= len(data)
+            stage(name, text)
+            print(f"Staged file: {name}")
+
+    print(f"Files staged: {len(updated_files_list)}, skipped: {skipped}") # DEBUG
 
     return updated_files_list
 
@@ -607,6 +746,7 @@ def handle_current_file_delete(n_clicks, current_files):
             filename_deleted = f['filename']
             break
     updated_files = [f for f in current_files if f['id'] != file_id_to_delete]
+    take_staged_text(file_id_to_delete)
     print(f"Deleted staged file: {filename_deleted}")
     return updated_files
 
@@ -625,184 +765,310 @@ def update_current_file_spacing(stored_files):
 
 # **Callback 5: Handle Submit button click**
 @callback(
-    Output('message-history-store', 'data', allow_duplicate=True),
+    Output('ask-job-store', 'data', allow_duplicate=True),
+    Output('ask-poll-interval', 'disabled', allow_duplicate=True),
+    Output('streaming-message', 'children', allow_duplicate=True),
+    Output('history-streaming', 'style', allow_duplicate=True),
     Output('my-textarea', 'value', allow_duplicate=True),
     Output('uploaded-files-store', 'data', allow_duplicate=True),
     Output('previous-chats-store', 'data', allow_duplicate=True),
     Output('current-chat-id-store', 'data', allow_duplicate=True),
+    Output('ask-error', 'children', allow_duplicate=True),
     Input('submit-button', 'n_clicks'),
     State('my-textarea', 'value'),
-    State('message-history-store', 'data'),
     State('current-selected-model-store', 'data'),
     State('uploaded-files-store', 'data'),
     State('previous-chats-store', 'data'),
     State('current-chat-id-store', 'data'),
+    State('ask-job-store', 'data'),
     prevent_initial_call='initial_duplicate'
 )
-def handle_submit(n_clicks, text_value, current_history, selected_model, 
-                  current_uploaded_files, previous_chats_list, current_chat_id):
-    # ... (code unchanged - already updates previous chats on every submit) ...
+def handle_submit(n_clicks, text_value, selected_model,
+                  current_uploaded_files, previous_chats_list, current_chat_id, current_job):
+    """
+    Starts answering in the background and shows the question,
+    poll_answer shows the answer as it is generated.
+    """
 
     print(f"asking: {text_value}")
 
-    _chat = bedrock.Chat(current_chat_id)
-
     processed_text_value = text_value.strip() if text_value else ""
     previous_chats_output = no_update
     current_chat_id_output = no_update
+    if current_job:
+        print("Submit: still answering the previous message.")
+        return (no_update,) * 9
     if processed_text_value or current_uploaded_files:
-        if current_history is None: current_history = []
         if current_uploaded_files is None: current_uploaded_files = []
+        if current_chat_id is None:
+            current_chat_id = str(uuid.uuid4())
+            current_chat_id_output = current_chat_id
+            print(f"Generated initial Chat ID: {current_chat_id}")
+        _chat = bedrock.Chat(current_chat_id)
         associated_filenames = [f['filename'] for f in current_uploaded_files]
+        attachments = []
         for f in current_uploaded_files:
-            content = f.get('content')
-            _chat.add_to_context(content)
-        answer = _chat.ask(processed_text_value)
-        answer_text = answer["text"]
-        if associated_filenames: answer_text += f" (Files: {', '.join(associated_filenames)})"
-        new_entry = {
-            'text': processed_text_value, 
-            'files': associated_filenames, 
-            'answer': answer_text,
-            'cost': answer["cost"],
-            'time': answer["time"],
-            }
-        updated_history = current_history + [new_entry]
+            # files staged again by editing a message whose file is no longer in the context have none
+            text = take_staged_text(f['id'])
+            if text is not None:
+                _chat.add_to_context(text, tag=f"file:{f['id']}")
+                attachments.append({'filename': f['filename'], 'id': f['id']})
+        # the message and file ids tag the context items, so that a file or the message can be removed later
+        entry = {'id': str(uuid.uuid4()), 'text': processed_text_value, 'files': associated_filenames, 'attachments': attachments}
+        job_id = start_ask(current_chat_id, entry)
         print(f"Submit Question: '{processed_text_value}', Files: {associated_filenames}, Model: '{selected_model}'")
-        if updated_history:
-            if current_chat_id is None:
-                current_chat_id = str(uuid.uuid4())
-                current_chat_id_output = current_chat_id
-                print(f"Generated initial Chat ID: {current_chat_id}")
-            updated_previous_chats = previous_chats_list if previous_chats_list is not None else []
-            summary = get_summary(updated_history[0].get('text', ''))
-            chat_entry = {'id': current_chat_id, 'summary': summary, 'history': updated_history}
-            found_index = -1
-            for i, chat in enumerate(updated_previous_chats):
-                if chat.get('id') == current_chat_id:
-                    found_index = i
-                    break
-            if found_index != -1:
-                updated_previous_chats[found_index] = chat_entry
-                print(f"Updated chat {current_chat_id} in previous list.")
-            else:
-                updated_previous_chats.insert(0, chat_entry)
-                print(f"Inserted new chat {current_chat_id} into previous list.")
+        updated_previous_chats = previous_chats_list if previous_chats_list is not None else []
+        if not any(chat.get('id') == current_chat_id for chat in updated_previous_chats):
+            updated_previous_chats.insert(0, {'id': current_chat_id, 'summary': get_summary(processed_text_value)})
+            print(f"Inserted new chat {current_chat_id} into previous list.")
             previous_chats_output = updated_previous_chats
-        return updated_history, "", [], previous_chats_output, current_chat_id_output
+        job = {'id': job_id, 'chat_id': current_chat_id, 'text': processed_text_value, 'files': associated_filenames}
+        return (job, False, render_streaming(job, ""), streaming_container_style,
+                "", [], previous_chats_output, current_chat_id_output, [])
     else:
         print("Submit: No text or files.")
-        return no_update, no_update, no_update, no_update, no_update
+        return (no_update,) * 9
+
+def render_streaming(job, partial_answer):
+    """Renders the question being answered and the answer so far."""
+    q_row = html.Div([html.Div("Q", style=q_box_style), html.Div(dcc.Markdown(job['text']), style=question_box_style)], style=message_qa_row_style)
+    children = [q_row]
+    if job['files']:
+        children.append(html.Div([html.Span(fname, style=message_filename_style) for fname in job['files']], style=message_files_style))
+    answer_box_div = html.Div(dcc.Markdown(partial_answer or "_Thinking…_", style={'margin': '0', 'padding': '0'}), style=answer_box_style)
+    children.append(html.Div([html.Div("A", style=a_box_style), answer_box_div], style={**message_qa_row_style, 'marginTop': '0.5em'}))
+    return html.Div(children, style=message_entry_style)
+
+# **Callback 5a: Show the answer as it is generated**
+@callback(
+    Output('streaming-message', 'children', allow_duplicate=True),
+    Output('history-streaming', 'style', allow_duplicate=True),
+    Output('ask-poll-interval', 'disabled', allow_duplicate=True),
+    Output('ask-job-store', 'data', allow_duplicate=True),
+    Output('message-history-store', 'data', allow_duplicate=True),
+    Output('my-textarea', 'value', allow_duplicate=True),
+    Output('ask-error', 'children', allow_duplicate=True),
+    Input('ask-poll-interval', 'n_intervals'),
+    State('ask-job-store', 'data'),
+    State('current-chat-id-store', 'data'),
+    prevent_initial_call=True
+)
+def poll_answer(n_intervals, current_job, current_chat_id):
+    """
+    Shows the partial answer, once the answer is finished moves it to the history.
+    A cancelled or failed question goes back to the textarea, with the error of a failed one.
+    An answer to another chat than the one shown is not shown, it is still saved to its chat.
+    """
+    if not current_job or current_job.get('chat_id', current_chat_id) != current_chat_id:
+        return [], streaming_container_hidden_style, True, None, no_update, no_update, no_update
+    with ask_jobs_lock:
+        job = ask_jobs.get(current_job['id'])
+        if job is None or job['cancel'].is_set() or job['finished']:
+            ask_jobs.pop(current_job['id'], None)
+    if job is not None and job['length'] is not None:
+        history = {'length': job['length'], 'op': job['op'], 'chat_id': current_chat_id}
+        return [], streaming_container_hidden_style, True, None, history, no_update, []
+    if job is None or job['cancel'].is_set() or job['finished']:
+        error = f"Not answered: {job['error']}" if job is not None and job['error'] else []
+        return [], streaming_container_hidden_style, True, None, no_update, current_job['text'], error
+    return render_streaming(current_job, "".join(job['parts'])), no_update, no_update, no_update, no_update, no_update, no_update
+
+# **Callback 5b: Stop answering**
+@callback(
+    Output('dummy-output', 'children', allow_duplicate=True),
+    Input('cancel-ask-button', 'n_clicks'),
+    State('ask-job-store', 'data'),
+    prevent_initial_call=True
+)
+def cancel_answer(n_clicks, current_job):
+    """Stops the model, poll_answer then clears the partial answer."""
+    if not n_clicks or not current_job:
+        return no_update
+    with ask_jobs_lock:
+        job = ask_jobs.get(current_job['id'])
+    if job is not None:
+        job['cancel'].set()
+    return no_update
 
 
 # **Callback 6: Render message history**
+def render_message(index, entry, is_last_message):
+    """Renders one history entry, the last one with its edit and delete buttons."""
+    msg = entry.get('text', '')
+    files = entry.get('files', [])
+    answer = entry.get('answer', '')
+    q_icon_div = html.Div("Q", style=q_box_style)
+    question_box_content = [dcc.Markdown(msg)]
+    if is_last_message:
+        edit_btn = html.Button(id={'type': 'edit-message-button', 'index': index}, children=[DashIconify(icon="mdi:pencil-outline", width=16)], style=action_icon_button_style, n_clicks=0, title="Edit this message")
+        delete_btn = html.Button(id={'type': 'delete-message-button', 'index': index}, children=[DashIconify(icon="mdi:trash-can-outline", width=16)], style=action_icon_button_style, n_clicks=0, title="Delete this message")
+        buttons = [edit_btn, delete_btn]
+        if entry.get('stale'):
+            # files were removed after the answer
+            buttons.insert(0, html.Button(id={'type': 'reask-message-button', 'index': index}, children=[DashIconify(icon="mdi:refresh", width=16)], style=action_icon_button_style, n_clicks=0, title="Ask again without the removed files"))
+        button_container = html.Div(buttons, style=action_button_container_style)
+        question_box_content.append(button_container)
+    question_box_div = html.Div(question_box_content, style=question_box_style)
+    qa_row = html.Div([q_icon_div, question_box_div], style=message_qa_row_style)
+    files_row = None
+    if files:
+        file_spans = []
+        for fname in files:
+            if is_last_message:
+                file_spans.append(html.Div([html.Span(fname, style=deletable_filename_text_style), html.Button(id={'type': 'delete-history-file', 'index': index, 'filename': fname}, children=[DashIconify(icon="mdi:trash-can-outline", width=16, style={'display': 'block'})], style=history_delete_button_style, n_clicks=0, title=f"Remove {fname}")], style=deletable_file_item_style))
+            else:
+                file_spans.append(html.Span(fname, style=message_filename_style))
+        files_row = html.Div(file_spans, style=message_files_style)
+    answer_row = None
+    if answer:
+        a_icon_div = html.Div("A", style=a_box_style)
+        # as of when the message was answered
+        current_model = entry.get('model', 'N/A')
+        context_length = entry.get('context_length', 'N/A')
+        cost = entry.get('cost', 0)
+        time = entry.get('time', 0)
+        meta = f"model: {current_model}, context length: {context_length}, cost: ${cost:.3f}, time: {time:.1f}s"
+        if entry.get('stale'): meta += ", files removed since"
+        answer_box_div = html.Div([
+            dcc.Markdown(answer, id=f"answer-text-{index}", style={'margin': '0', 'padding': '0'}), 
+            html.Div(meta, style=model_display_style), # Display the model name
+            html.Button(id={'type': 'copy-answer-button', 'index': index}, children=[DashIconify(icon="mdi:content-copy", width=16)], style=bottom_right_button_style, n_clicks=0, title="Copy answer to clipboard")], style=answer_box_style)
+        answer_row = html.Div([a_icon_div, answer_box_div], style={**message_qa_row_style, 'marginTop': '0.5em'})
+    message_entry_children = [qa_row]
+    if files_row: message_entry_children.append(files_row)
+    if answer_row: message_entry_children.append(answer_row)
+    return html.Div(message_entry_children, style=message_entry_style, key=f"msg-{index}")
+
 @callback(
-    Output('submitted-text-display', 'children'),
+    Output('history-past', 'children'),
+    Output('history-last', 'children'),
     Input('message-history-store', 'data'),
     State('current-chat-id-store', 'data'),
 )
-def render_message_history(message_list, current_chat_id):
-
-    _chat = bedrock.Chat(current_chat_id)
+def render_message_history(history_state, current_chat_id):
+    """
+    Renders only what changed: on 'append' the previous last message moves to history-past
+    without its buttons, on 'pop' the one before the last moves back, on 'update' only the last is rendered.
+    'load' renders every message, as does a change that is no longer in the store.
+    A change to another chat than the one shown is ignored.
+    """
+    length = (history_state or {}).get('length', 0)
+    op = (history_state or {}).get('op', 'load')
+    if (history_state or {}).get('chat_id', current_chat_id) != current_chat_id:
+        return no_update, no_update
+    if not current_chat_id or length == 0:
+        return [], []
+    store = history_store()
+
+    def load():
+        message_list = store.load_history(current_chat_id)
+        if not message_list:
+            return [], []
+        past = [render_message(index, entry, False) for index, entry in enumerate(message_list[:-1])]
+        return past, render_message(len(message_list) - 1, message_list[-1], True)
+
+    if op == 'load':
+        return load()
+
+    start = max(length - 2, 0) if op == 'append' else length - 1
+    message_list = store.load_history(current_chat_id, start)
+    if len(message_list) != length - start:
+        # the history changed meanwhile, e.g. in another tab
+        return load()
+    past = Patch()
+    if op == 'append':
+        if length > 1:
+            past.append(render_message(length - 2, message_list[0], False))
+        else:
+            past = no_update
+    elif op == 'pop':
+        del past[length - 1]
+    else:
+        past = no_update
+    return past, render_message(length - 1, message_list[-1], True)
 
-    # ... (code unchanged) ...
-    if not message_list: return []
-    message_elements = []
-    num_messages = len(message_list)
-    for index, entry in enumerate(message_list):
-        is_last_message = (index == num_messages - 1)
-        msg = entry.get('text', '')
-        files = entry.get('files', [])
-        answer = entry.get('answer', '')
-        model_used = entry.get('model_used', 'N/A') # Get the model name
-        q_icon_div = html.Div("Q", style=q_box_style)
-        question_box_content = [dcc.Markdown(msg)]
-        if is_last_message:
-            edit_btn = html.Button(id={'type': 'edit-message-button', 'index': index}, children=[DashIconify(icon="mdi:pencil-outline", width=16)], style=action_icon_button_style, n_clicks=0, title="Edit this message")
-            delete_btn = html.Button(id={'type': 'delete-message-button', 'index': index}, children=[DashIconify(icon="mdi:trash-can-outline", width=16)], style=action_icon_button_style, n_clicks=0, title="Delete this message")
-            button_container = html.Div([edit_btn, delete_btn], style=action_button_container_style)
-            question_box_content.append(button_container)
-        question_box_div = html.Div(question_box_content, style=question_box_style)
-        qa_row = html.Div([q_icon_div, question_box_div], style=message_qa_row_style)
-        files_row = None
-        if files:
-            file_spans = []
-            for fname in files:
-                if is_last_message:
-                    file_spans.append(html.Div([html.Span(fname, style=deletable_filename_text_style), html.Button(id={'type': 'delete-history-file', 'index': index, 'filename': fname}, children=[DashIconify(icon="mdi:trash-can-outline", width=16, style={'display': 'block'})], style=history_delete_button_style, n_clicks=0, title=f"Remove {fname}")], style=deletable_file_item_style))
-                else:
-                    file_spans.append(html.Span(fname, style=message_filename_style))
-            files_row = html.Div(file_spans, style=message_files_style)
-        answer_row = None
-        if answer:
-            a_icon_div = html.Div("A", style=a_box_style)
-            current_model = _chat.list_models()[0]
-            context_length = _chat.context_length()
-            cost = entry.get('cost', 0)
-            time = entry.get('time', 0)
-            meta = f"model: {current_model}, context length: {context_length}, cost: ${cost:.3f}, time: {time:.1f}s"
-            answer_box_div = html.Div([
-                dcc.Markdown(answer, id=f"answer-text-{index}", style={'margin': '0', 'padding': '0'}), 
-                html.Div(meta, style=model_display_style), # Display the model name
-                html.Button(id={'type': 'copy-answer-button', 'index': index}, children=[DashIconify(icon="mdi:content-copy", width=16)], style=bottom_right_button_style, n_clicks=0, title="Copy answer to clipboard")], style=answer_box_style)
-            answer_row = html.Div([a_icon_div, answer_box_div], style={**message_qa_row_style, 'marginTop': '0.5em'})
-        message_entry_children = [qa_row]
-        if files_row: message_entry_children.append(files_row)
-        if answer_row: message_entry_children.append(answer_row)
-        message_entry = html.Div(message_entry_children, style=message_entry_style, key=f"msg-{index}")
-        message_elements.append(message_entry)
-    return message_elements
 
 # **Callback 7: Handle file deletion from last message**
 @callback(
     Output('message-history-store', 'data', allow_duplicate=True),
     Input({'type': 'delete-history-file', 'index': ALL, 'filename': ALL}, 'n_clicks'),
-    State('message-history-store', 'data'),
-    State('current-selected-model-store', 'data'),
     State('current-chat-id-store', 'data'),
     prevent_initial_call='initial_duplicate'
 )
-def handle_history_file_delete(n_clicks, current_history, selected_model, current_chat_id):
-    # ... (code unchanged - already prints filename) ...
+def handle_history_file_delete(n_clicks, current_chat_id):
+    """
+    Removes the file from the context where it is, without asking again.
+    The answer is marked stale and the re-ask button asks again.
+    """
     triggered = ctx.triggered_id
     if not triggered or not isinstance(triggered, dict) or triggered.get('type') != 'delete-history-file' or not any(n > 0 for n in n_clicks if n is not None): return no_update
     msg_index = triggered['index']
     filename_to_delete = triggered['filename']
-    if not current_history or msg_index != len(current_history) - 1: return no_update
-    last_entry = current_history[-1]
-    original_text = last_entry.get('text', '')
-    original_files = last_entry.get('files', [])
-    remaining_files = [f for f in original_files if f != filename_to_delete]
+    store = history_store()
+    if not current_chat_id or msg_index != store.history_length(current_chat_id) - 1: return no_update
+    last_entry = store.load_history(current_chat_id, msg_index)[0]
+    removed = [a for a in last_entry.get('attachments', []) if a['filename'] == filename_to_delete]
+    if removed:
+        bedrock.Chat(current_chat_id).remove_tagged(*[f"file:{a['id']}" for a in removed])
+    else:
+        print(f"File '{filename_to_delete}' has no tag, it stays in the context.")
+    last_entry['files'] = [f for f in last_entry.get('files', []) if f != filename_to_delete]
+    last_entry['attachments'] = [a for a in last_entry.get('attachments', []) if a['filename'] != filename_to_delete]
+    last_entry['stale'] = True
+    print(f"Deleted history file '{filename_to_delete}'.")
+    return {'length': store.put_history(current_chat_id, msg_index, last_entry), 'op': 'update'}
+
+# **Callback 7a: Ask the last message again**
+@callback(
+    Output('ask-job-store', 'data', allow_duplicate=True),
+    Output('ask-poll-interval', 'disabled', allow_duplicate=True),
+    Output('streaming-message', 'children', allow_duplicate=True),
+    Output('history-streaming', 'style', allow_duplicate=True),
+    Output('ask-error', 'children', allow_duplicate=True),
+    Input({'type': 'reask-message-button', 'index': ALL}, 'n_clicks'),
+    State('current-chat-id-store', 'data'),
+    State('ask-job-store', 'data'),
+    prevent_initial_call=True
+)
+def handle_reask(n_clicks, current_chat_id, current_job):
+    """Replaces the question and answer in the context and the answer in the history, the files stay as they are."""
+    triggered = ctx.triggered_id
+    if not triggered or not isinstance(triggered, dict) or not any(n > 0 for n in n_clicks if n is not None) or current_job: return (no_update,) * 5
+    msg_index = triggered['index']
+    store = history_store()
+    if not current_chat_id or msg_index != store.history_length(current_chat_id) - 1: return (no_update,) * 5
+    last_entry = store.load_history(current_chat_id, msg_index)[0]
     _chat = bedrock.Chat(current_chat_id)
-    _chat.remove_from_context(len(original_files) + 1)
-    for f in remaining_files:
-            content = f.get('content')
-            _chat.add_to_context(content)
-    new_answer_text = _chat.ask(original_text)["text"]
-    if remaining_files: new_answer_text += f" (Files: {', '.join(remaining_files)})"
-    else: new_answer_text += " (No files remaining)"
-    current_history[-1]['files'] = remaining_files
-    current_history[-1]['answer'] = new_answer_text
-    print(f"Deleted history file '{filename_to_delete}', re-answered.")
-    return current_history
+    if last_entry.get('id'):
+        _chat.remove_tagged(f"msg:{last_entry['id']}")
+    else:
+        # saved before items were tagged, the question and the answer are the last two items
+        _chat.remove_from_context(2)
+        last_entry['id'] = str(uuid.uuid4())
+    entry = {'id': last_entry['id'], 'text': last_entry.get('text', ''), 'files': last_entry.get('files', []), 'attachments': last_entry.get('attachments', [])}
+    job_id = start_ask(current_chat_id, entry, msg_index)
+    print(f"Asking message index {msg_index} again")
+    job = {'id': job_id, 'chat_id': current_chat_id, 'text': entry['text'], 'files': entry['files']}
+    return job, False, render_streaming(job, ""), streaming_container_style, []
 
 # **Callback 8: Handle deletion of the entire last message**
 @callback(
     Output('message-history-store', 'data', allow_duplicate=True),
     Input({'type': 'delete-message-button', 'index': ALL}, 'n_clicks'),
-    State('message-history-store', 'data'),
+    State('current-chat-id-store', 'data'),
     prevent_initial_call='initial_duplicate'
 )
-def handle_message_delete(n_clicks, current_history):
-    # ... (code unchanged - already prints text) ...
+def handle_message_delete(n_clicks, current_chat_id):
     triggered = ctx.triggered_id
     if not triggered or not isinstance(triggered, dict) or triggered.get('type') != 'delete-message-button' or not any(n > 0 for n in n_clicks if n is not None): return no_update
     msg_index = triggered['index']
-    if not current_history or msg_index != len(current_history) - 1: return no_update
-    text_deleted = current_history[-1].get('text', '[empty question]')
-    print(f"Deleting last message (index {msg_index}): '{text_deleted}'")
-    updated_history = current_history[:-1]
-    return updated_history
+    store = history_store()
+    if not current_chat_id or msg_index != store.history_length(current_chat_id) - 1: return no_update
+    print(f"Deleting last message (index {msg_index})")
+    last_entry = store.load_history(current_chat_id, msg_index)[0]
+    bedrock.Chat(current_chat_id).remove_tagged(*message_tags(last_entry))
+    store.truncate_history(current_chat_id, msg_index)
+    return {'length': msg_index, 'op': 'pop'}
 
 # **Callback 9: Handle Edit button click**
 @callback(
@@ -810,22 +1076,29 @@ def handle_message_delete(n_clicks, current_history):
     Output('uploaded-files-store', 'data', allow_duplicate=True),
     Output('message-history-store', 'data', allow_duplicate=True),
     Input({'type': 'edit-message-button', 'index': ALL}, 'n_clicks'),
-    State('message-history-store', 'data'),
+    State('current-chat-id-store', 'data'),
     prevent_initial_call='initial_duplicate'
 )
-def handle_edit_message(n_clicks, current_history):
-    # ... (code unchanged - already prints text) ...
+def handle_edit_message(n_clicks, current_chat_id):
+    """Takes the last message out of the history and the context and stages it and its files again."""
     triggered = ctx.triggered_id
     if not triggered or not isinstance(triggered, dict) or triggered.get('type') != 'edit-message-button' or not any(n > 0 for n in n_clicks if n is not None): return no_update, no_update, no_update
     msg_index = triggered['index']
-    if not current_history or msg_index != len(current_history) - 1: return no_update, no_update, no_update
-    last_entry = current_history[-1]
+    store = history_store()
+    if not current_chat_id or msg_index != store.history_length(current_chat_id) - 1: return no_update, no_update, no_update
+    last_entry = store.load_history(current_chat_id, msg_index)[0]
     text_to_edit = last_entry.get('text', '')
-    files_to_edit_names = last_entry.get('files', [])
-    files_for_staging = [{'filename': name, 'id': str(uuid.uuid4())} for name in files_to_edit_names]
-    updated_history = current_history[:-1]
+    _chat = bedrock.Chat(current_chat_id)
+    files_for_staging = [{'filename': a['filename'], 'id': a['id']} for a in last_entry.get('attachments', [])] or [{'filename': name, 'id': str(uuid.uuid4())} for name in last_entry.get('files', [])]
+    # the file texts are taken from the context before they are removed from it
+    texts = {item.tag: item.text for item in _chat.get_context() if item.tag}
+    for f in files_for_staging:
+        if f"file:{f['id']}" in texts:
+            stage_text(f['id'], texts[f"file:{f['id']}"])
+    _chat.remove_tagged(*message_tags(last_entry))
+    store.truncate_history(current_chat_id, msg_index)
     print(f"Editing message index {msg_index}: '{text_to_edit}'")
-    return text_to_edit, files_for_staging, updated_history
+    return text_to_edit, files_for_staging, {'length': msg_index, 'op': 'pop'}
 
 
 # **Callback 10: Example callback for dropdown change**
@@ -859,7 +1132,7 @@ def update_model_selection(n_clicks):
         return no_update, no_update
 
     selected_value = triggered_id['value']
-    selected_label = next((item['label'] for item in models() if item['value'] == selected_value), "Select Model")
+    selected_label = next((item['label'] for item in model_options if item['value'] == selected_value), "Select Model")
 
     print(f"Model selection updated to: {selected_value}")
     return selected_value, selected_label
@@ -920,7 +1193,7 @@ clientside_callback(
 # ** Clientside Callback: Scroll chat history to bottom **
 clientside_callback(
     """
-    function(children) {
+    function(children, streaming) {
         // Add slight delay to allow DOM to update if necessary
         setTimeout(function() {
             const element = document.getElementById('submitted-text-display');
@@ -937,7 +1210,8 @@ clientside_callback(
     }
     """,
     Output('dummy-output', 'children', allow_duplicate=True), # Use dummy output
-    Input('submitted-text-display', 'children'),
+    Input('history-last', 'children'),
+    Input('streaming-message', 'children'),
     prevent_initial_call=True # Don't scroll on initial load
 )
 
@@ -1026,4 +1300,6 @@ clientside_callback(
 )
 
 def __name__():
+    # the context is first used in a callback thread, where the SIGTERM flush cannot be set up
+    bedrock.Chat.context_manager.install_shutdown_flush()
     app.run(debug=True)
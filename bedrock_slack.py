@@ -1,6 +1,11 @@
-import datetime
 import logging
 import os
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 
 from logging.handlers import RotatingFileHandler
 from slack_bolt import App
@@ -8,8 +13,14 @@ from slack_bolt.adapter.socket_mode import SocketModeHandler
 
 import requests
 
+from requests.adapters import HTTPAdapter
+
 import bedrock
 
+# files shared with the bot that are larger than this are not added to the context
+MAX_FILE_BYTES = int(os.environ.get("SLACK_MAX_FILE_BYTES", 2 * 1024 * 1024))
+CHUNK_BYTES = 64 * 1024
+
 def _setup_logging():
     file_handler = RotatingFileHandler("slack_bedrock.log", maxBytes=10*1024*1024, backupCount=100)
     file_handler.setLevel(logging.INFO)
@@ -22,8 +33,142 @@ def _setup_logging():
     root_logger.addHandler(file_handler)
     root_logger.addHandler(console_handler)
 
+def _session(pool_size):
+    """
+    A session that keeps up to pool_size connections to the file host open between downloads
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=3)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def download_text(session, url, token, max_bytes=MAX_FILE_BYTES):
+    """
+    Streams a file hosted by Slack and returns its text, decoded chunk by chunk.
+    Raises when the file is larger than max_bytes, is not text or the bot may not read it.
+    """
+    headers = {"Authorization": f"Bearer {token}"}
+    with session.get(url, headers=headers, stream=True, timeout=(5, 60)) as response:
+        response.raise_for_status()
+        # without the files:read scope Slack redirects to its login page
+        if response.history and response.headers.get("Content-Type", "").startswith("text/html"):
+            raise Exception("Slack returned its login page, the app needs the files:read scope")
+        if int(response.headers.get("Content-Length", 0)) > max_bytes:
+            raise Exception(f"the file is larger than {max_bytes} bytes")
+        text, why = bedrock.decode_text(response.iter_content(chunk_size=CHUNK_BYTES), max_bytes)
+    if why == "too large":
+        raise Exception(f"the file is larger than {max_bytes} bytes")
+    if why == "binary":
+        raise Exception("the file is not text")
+    return text
+
+def _percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+class ConversationQueue():
+
+    """
+    Runs tasks on a bounded pool of threads, one at a time and in order per key (channel:user)
+    and different keys in parallel. At most max_pending tasks wait, stats() has the queue depth
+    and the wait and run times of the last window tasks.
+    """
+
+    def __init__(self, workers=8, max_pending=1000, window=200):
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="slack-worker")
+        self._lock = threading.Lock()
+        # per key with a task running, the tasks waiting behind it
+        self._waiting = {}
+        self._pending = 0
+        self._running = 0
+        self._completed = 0
+        self._failed = 0
+        self._wait_times = deque(maxlen=window)
+        self._run_times = deque(maxlen=window)
+
+    def depth(self, key):
+        """
+        Returns how many tasks of key are running or waiting
+        """
+        with self._lock:
+            return len(self._waiting[key]) + 1 if key in self._waiting else 0
+
+    def submit(self, key, task):
+        """
+        Queues task after the other tasks of key, returns False when max_pending tasks are waiting
+        """
+        with self._lock:
+            if self._pending >= self.max_pending:
+                return False
+            self._pending += 1
+            if key in self._waiting:
+                self._waiting[key].append((task, time.time()))
+            else:
+                self._waiting[key] = deque()
+                self._executor.submit(self._run, key, task, time.time())
+            return True
+
+    def _run(self, key, task, enqueued):
+        started = time.time()
+        with self._lock:
+            self._pending -= 1
+            self._running += 1
+        ok = True
+        try:
+            task()
+        except Exception as e:
+            ok = False
+            logging.getLogger(__name__).error(f"Task for {key} failed at {datetime.now()}: {e}")
+        with self._lock:
+            self._running -= 1
+            self._completed += 1
+            if not ok:
+                self._failed += 1
+            self._wait_times.append(started - enqueued)
+            self._run_times.append(time.time() - started)
+            # the next task of the same key goes to the back of the pool so that other keys get their turn
+            if self._waiting[key]:
+                next_task, next_enqueued = self._waiting[key].popleft()
+                self._executor.submit(self._run, key, next_task, next_enqueued)
+            else:
+                del self._waiting[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pending": self._pending,
+                "running": self._running,
+                "conversations": len(self._waiting),
+                "completed": self._completed,
+                "failed": self._failed,
+                "p50_wait": _percentile(self._wait_times, 0.5),
+                "p95_wait": _percentile(self._wait_times, 0.95),
+                "p50_run": _percentile(self._run_times, 0.5),
+                "p95_run": _percentile(self._run_times, 0.95),
+            }
+
 class Slack():
 
+    def __init__(self):
+        # commands are answered by a bounded pool of workers, in order per channel:user
+        workers = int(os.environ.get("SLACK_WORKERS", 8))
+        self.queue = ConversationQueue(workers=workers, max_pending=int(os.environ.get("SLACK_MAX_PENDING", 1000)))
+        # for files shared with the bot, one connection per worker
+        self._session = _session(workers)
+        # (channel id, user id) to the channel:user of the slash commands
+        self._context_ids = {}
+
+    def _log_stats(self, logger):
+        stats = self.queue.stats()
+        logger.info(
+            f"Queue: {stats['pending']} waiting, {stats['running']} running, {stats['completed']} done, {stats['failed']} failed, "
+            f"wait p50 {stats['p50_wait'] or 0:.2f}s p95 {stats['p95_wait'] or 0:.2f}s, "
+            f"run p50 {stats['p50_run'] or 0:.2f}s p95 {stats['p95_run'] or 0:.2f}s")
+
     def ask(self, args):
 
         start = datetime.now()
@@ -43,10 +188,36 @@ class Slack():
         args.logger.setLevel("INFO")
         args.logger.info(f"Request at {datetime.now()} from {context_id}: {question}")
 
+        # post right away, a worker replaces the message with the answer
+        ahead = self.queue.depth(context_id)
+        status = f"_Waiting for {ahead} earlier question{'s' if ahead > 1 else ''}…_" if ahead else "_Thinking…_"
+        message = args.say(f"*Question:*\n{question}\n\n{status}")
+
+        if not self.queue.submit(context_id, lambda: self._answer(args, context_id, user, question, message, start)):
+            args.client.chat_update(
+                channel=message["channel"], ts=message["ts"],
+                text=f"*Question:*\n{question}\n\nToo many questions are waiting, please ask again in a minute.")
+            args.logger.info(f"Queue full, rejected {context_id}")
+
+    def _answer(self, args, context_id, user, question, message, start):
+
         try:
-        
+
+            # update the message as the answer is generated
+            last_update = time.time()
+            text = ""
+
             # send the question with the context to bedrock
-            answer = bedrock.Chat(context_id).ask(question)
+            for part in bedrock.Chat(context_id).ask_stream(question):
+                if isinstance(part, dict):
+                    answer = part
+                    break
+                text += part
+                # Slack rate limits chat.update to about one per second per channel
+                if time.time() - last_update > 1:
+                    args.client.chat_update(
+                        channel=message["channel"], ts=message["ts"], text=f"*Question:*\n{question}\n\n{text}…")
+                    last_update = time.time()
             
             # form the response to Slack
             # answer["context_length"] = context_text_length
@@ -96,7 +267,7 @@ class Slack():
             }
 
             # respond to Slack
-            args.say(blocks)
+            args.client.chat_update(channel=message["channel"], ts=message["ts"], **blocks)
 
             # log
             end = datetime.now()
@@ -104,7 +275,9 @@ class Slack():
                 f"Response at {end} for {context_id} with {answer['model']} taking {(end-start).total_seconds()} seconds costing ${answer['cost']:f}")
 
         except Exception as e:
-            args.say(f"Error: {e}")
+            args.client.chat_update(channel=message["channel"], ts=message["ts"], text=f"*Question:*\n{question}\n\nError: {e}")
+
+        self._log_stats(args.logger)
         
 
     def clear(self, args):
@@ -112,12 +285,15 @@ class Slack():
         channel = args.body["channel_name"]
         user = args.body["user_name"]
         context_id = f"{channel}:{user}"
-        
-        bedrock.Chat(context_id).clear_context()
 
-        args.logger.info("Context cleared")
+        def clear_context():
+            bedrock.Chat(context_id).clear_context()
+            args.logger.info("Context cleared")
+            args.say("Clear the context")
 
-        args.say("Clear the context")
+        # after the questions asked before it
+        if not self.queue.submit(context_id, clear_context):
+            args.say("Too many questions are waiting, please try again in a minute.")
 
 
     def model(self, args):
@@ -151,49 +327,63 @@ class Slack():
         args.say(body["text"])
 
 
+    def _context_id(self, client, event):
+        """
+        Events have channel and user ids where slash commands have names,
+        returns the same channel:user as the commands use
+        """
+        key = (event["channel"], event["user"])
+        if key not in self._context_ids:
+            if event.get("channel_type") == "im":
+                channel = "directmessage"
+            else:
+                channel = client.conversations_info(channel=event["channel"])["channel"]["name"]
+            user = client.users_info(user=event["user"])["user"]["name"]
+            self._context_ids[key] = f"{channel}:{user}"
+        return self._context_ids[key]
+
     def handle_files(self, args):
+        """
+        Adds the text files shared with the bot to the context of the user in that channel:
+        the files of direct messages and, in channels, of messages that mention the bot
+        """
 
         args.ack()
-        
-        if "event" in args.body:
 
-            event = args.body.get("event", {})
+        event = args.body.get("event", {})
+        if not event.get("files") or event.get("bot_id"):
+            return
+        # not every file anyone shares in a channel the bot is in
+        if event.get("channel_type") != "im" and f"<@{args.context.bot_user_id}>" not in event.get("text", ""):
+            return
+
+        context_id = self._context_id(args.client, event)
 
-            if "files" in event:
-                for file in event["files"]:
+        # in order with the questions of the same user
+        for file in event["files"]:
+            if not self.queue.submit(context_id, lambda file=file: self._add_file(args, context_id, file)):
+                args.say(f"Too many questions are waiting, please share {file.get('name')} again in a minute.")
 
-                    download_url = file.get("url_private_download")
-                    print(download_url)
+    def _add_file(self, args, context_id, file):
 
-                    """
-                    file_id = file.get("id")
-                    response = args.client.files_info(file=file_id)
-                    file_info = response.get("file", {})
-                    download_url = file_info.get("url_private_download")
-                    print(download_url)
-                    """
+        name = file.get("name", file.get("id"))
+        if file.get("size", 0) > MAX_FILE_BYTES:
+            args.say(f"{name} is larger than {MAX_FILE_BYTES // 1024} KB, it was not added to the context")
+            return
 
-                    headers = {
-                        "Authorization": f"Bearer {args.client.token}"
-                    }
-                    
-                    # THIS DOES NOT WORK FOR AN UNKNOWN REASON
-                    # the goal was to upload files as a context
-                    file_content = requests.get(download_url, headers=headers)
-                    
-                    """
-                    if file_content.status_code > 199 and file_content.status_code < 300:
-                        # print(file_content.content)
-                        file_name = file.get("name", None)
-                        with open(f"slack-download-{file_name}", "wb") as f:
-                            f.write(file_content.content)
-                        args.say(f"File '{file_name}' has been downloaded successfully!")
-                    else:
-                        args.say(f"Failed to download the file: {file_name}")
-                    """
+        try:
+            start = datetime.now()
+            text = download_text(self._session, file["url_private_download"], args.client.token)
+            bedrock.Chat(context_id).add_to_context(text, tag=f"file:{file['id']}")
+            args.logger.info(f"Added {name} ({len(text)} characters) to {context_id} in {(datetime.now() - start).total_seconds()} seconds")
+            args.say(f"Added {name} to the context")
+        except Exception as e:
+            args.say(f"Could not add {name} to the context: {e}")
 
 def slack():
     _setup_logging()
+    # the context is first used on a worker thread, where the SIGTERM flush cannot be set up
+    bedrock.Chat.context_manager.install_shutdown_flush()
     app = App(token=os.environ.get("SLACK_BOT_TOKEN"))
     slack = Slack()
     app.command("/llm")(slack.ask)
@@ -202,7 +392,7 @@ def slack():
     app.command("/llmh")(slack.help)
     
     # app.command("/llmt")(slack.test)
-    # app.event("message")(slack.handle_files)
+    app.event("message")(slack.handle_files)
 
     slack = SocketModeHandler(app, os.environ["SLACK_APP_TOKEN"])
     slack.start()
@@ -0,0 +1,151 @@
+###############################################################
+# A local stand-in for the bedrock-runtime converse and converse_stream APIs.
+#
+# python bedrock_stub.py --port 8900 --latency 0.5
+# BEDROCK_ENDPOINT_URL=http://localhost:8900 AWS_REGION=us-east-1 \
+#   AWS_ACCESS_KEY_ID=stub AWS_SECRET_ACCESS_KEY=stub python bedrock_cli.py
+###############################################################
+
+import argparse
+import json
+import re
+import struct
+import time
+import zlib
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+def event_message(event_type, payload):
+    """
+    Encodes one event of the vnd.amazon.eventstream format used by converse_stream
+    """
+    headers = b""
+    for name, value in ((":event-type", event_type), (":content-type", "application/json"), (":message-type", "event")):
+        name, value = name.encode("utf-8"), value.encode("utf-8")
+        # 7 is the string header type
+        headers += struct.pack(">B", len(name)) + name + struct.pack(">BH", 7, len(value)) + value
+    payload = json.dumps(payload).encode("utf-8")
+    prelude = struct.pack(">II", 16 + len(headers) + len(payload), len(headers))
+    message = prelude + struct.pack(">I", zlib.crc32(prelude)) + headers + payload
+    return message + struct.pack(">I", zlib.crc32(message))
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    # headers and body are separate writes, with Nagle a kept alive connection waits for a delayed ack
+    disable_nagle_algorithm = True
+
+    # set by serve()
+    latency = 0.0
+    out_tokens = 100
+    # prompt prefixes marked with a cache point
+    prefixes = set()
+
+    def do_POST(self):
+
+        match = re.match(r"^/model/(.+)/(converse|converse-stream)$", self.path)
+        if not match:
+            self.send_error(404, f"Unknown path {self.path}")
+            return
+
+        model_id = unquote(match.group(1))
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        usage = self._usage(model_id, body.get("messages", []))
+
+        answer = f"{model_id} answers {usage['totalTokens'] - self.out_tokens} tokens"
+        metrics = {"latencyMs": int(self.latency * 1000)}
+
+        if match.group(2) == "converse-stream":
+            self._stream(answer, usage, metrics)
+            return
+
+        time.sleep(self.latency)
+
+        response = {
+            "output": {"message": {"role": "assistant", "content": [{"text": answer}]}},
+            "stopReason": "end_turn",
+            "usage": usage,
+            "metrics": metrics,
+        }
+        data = json.dumps(response).encode("utf-8")
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _usage(self, model_id, messages):
+        """
+        Roughly 4 characters per token. As with Bedrock, the longest prefix before a cache point
+        that the same model saw before is a cache read, the text after it up to the last cache point a cache write.
+        """
+        content = [c for m in messages for c in m.get("content", [])]
+        cached = 0
+        read = 0
+        for i, c in enumerate(content):
+            if "cachePoint" in c:
+                prefix = "".join([p.get("text", "") for p in content[:i]])
+                key = (model_id, zlib.crc32(prefix.encode("utf-8")))
+                cached = len(prefix) // 4
+                if key in self.prefixes:
+                    read = cached
+                self.prefixes.add(key)
+        text = "".join([c.get("text", "") for c in content])
+        in_tokens = len(text) // 4 - cached
+        usage = {"inputTokens": in_tokens, "outputTokens": self.out_tokens}
+        if read:
+            usage["cacheReadInputTokens"] = read
+        if cached > read:
+            usage["cacheWriteInputTokens"] = cached - read
+        usage["totalTokens"] = in_tokens + cached + self.out_tokens
+        return usage
+
+    def _stream(self, answer, usage, metrics):
+        """
+        Sends the answer word by word, the latency is spread over the words
+        """
+        words = answer.split(" ")
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/vnd.amazon.eventstream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def send(event_type, payload):
+            data = event_message(event_type, payload)
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+        send("messageStart", {"role": "assistant"})
+        for i, word in enumerate(words):
+            time.sleep(self.latency / len(words))
+            send("contentBlockDelta", {"contentBlockIndex": 0, "delta": {"text": word if i == 0 else " " + word}})
+        send("contentBlockStop", {"contentBlockIndex": 0})
+        send("messageStop", {"stopReason": "end_turn"})
+        send("metadata", {"usage": usage, "metrics": metrics})
+        self.wfile.write(b"0\r\n\r\n")
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(port=8900, latency=0.0, out_tokens=100):
+    StubHandler.latency = latency
+    StubHandler.out_tokens = out_tokens
+    server = ThreadingHTTPServer(("localhost", port), StubHandler)
+    server.daemon_threads = True
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per call")
+    parser.add_argument("--out-tokens", type=int, default=100)
+    args = parser.parse_args()
+
+    print(f"Serving converse on http://localhost:{args.port}")
+    try:
+        serve(args.port, args.latency, args.out_tokens).serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -15,6 +15,9 @@ import threading
 import time
 import traceback
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+
 import cherrypy
 import multiprocessing
 import pylru
@@ -176,7 +179,7 @@ class GrabThread(threading.Thread):
 
 class Grab(object):
 
-    def __init__(self, client_abbr, retries, verbose, tm_id=None):
+    def __init__(self, client_abbr, retries, verbose, tm_id=None, download_workers=None):
         self.tm_id = tm_id
         self.retries = 4 if retries else 1
         socket.setdefaulttimeout(180)
@@ -199,6 +202,13 @@ class Grab(object):
         self.s3_bucket = None
         self.s3_path = None
 
+        # files of a session are downloaded this many at a time, over kept alive connections
+        self.download_workers = download_workers or int(os.environ.get("GRAB_DOWNLOAD_WORKERS", 4))
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=self.download_workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
     def retry(self, partial):
         return retry(partial, retries=self.retries, client_abbr=self.client_abbr)
 
@@ -279,7 +289,7 @@ class Grab(object):
 
         print(self.get_uri('/session/'))
 
-        response = self.retry(functools.partial(requests.get,
+        response = self.retry(functools.partial(self.session.get,
                                                 self.get_uri('/session/'),
                                                 params=args,
                                                 headers=self.request_headers,
@@ -307,7 +317,7 @@ class Grab(object):
             shutil.rmtree(dest_dir, True)
             os.makedirs(dest_dir) #os.makedirs(dest_dir, 0755)
 
-            start = cur_time = time.time()
+            start = time.time()
             if self.verbose:
                 sys.stdout.write("  * getting haus files")
             multi_file = len(files) > 1
@@ -315,54 +325,46 @@ class Grab(object):
             if settings.DEBUG and self.verbose:
                 sys.stdout.write(" (connecting...)")
 
-            fetched = 0
-            actual = None
-
-            for f in files:
-                response = self.retry(functools.partial(requests.get,
-                                                        self.get_uri('/entity/'),
-                                                        params={"access_token": token, 'filename': f},
-                                                        headers=self.request_headers,
-                                                        stream=True,
-                                                        **self.ssl_args))
-                compressed = True if response.headers.get('content-encoding') == 'gzip' else False
-
-                if response.status_code != requests.codes.ok:
-                    raise Exception("Unable to read session: %s" % response.text)
-
-                block = None
-                chunk_size = 9000
-                with open('%s/%s' % (dest_dir, f), 'wb') as d:
-                    for block in response.iter_content(chunk_size):
-                        cur_time = time.time()
-                        # do this here so we don't throw it for the last chunk, which is allowed to be smaller
-                        if not multi_file and not compressed and actual is not None and actual < chunk_size:
-                            if self.verbose:
-                                print("\r  * chunk starting at %s of %s was less than expected: %s of %s" % (fetched,
-                                                                                                             total_size,
-                                                                                                             actual,
-                                                                                                             chunk_size))
-
-                        actual = len(block)
-                        fetched += actual
-
-                        d.write(block)
-
-                        if settings.DEBUG and self.verbose:
-                            rate = round(fetched / 1024 / 1024 / (cur_time - start), 1)
-                            sys.stdout.write("\r  * getting haus files (%s%% of %sMB %scompressed) %s MB/s   " %
-                                             (int((float(fetched) / total_size) * 100), total_size_mb, 'un' if not compressed else '', rate))
-
-                if not multi_file:
-                    if self.verbose:
-                        print("\n    Fetched %sMB in %s seconds" % (total_size_mb, round(cur_time - start, 1)))
-                if not multi_file and fetched != total_size:
-                    print("  WARNING only received %s out of %s bytes. last chunk size was %s." % (fetched,
-                                                                                                   total_size,
-                                                                                                   actual))
-                    print("  response code was %s. last block was:" % (response.status_code))
-                    if block is not None:
-                        print(block + "\n")  # let's see what we got
+            progress = {"fetched": 0, "files": 0, "compressed": False, "printed": 0}
+            progress_lock = threading.Lock()
+
+            def report(size, finished=False):
+                with progress_lock:
+                    progress["fetched"] += size
+                    progress["files"] += 1 if finished else 0
+                    now = time.time()
+                    # the line is redrawn at most twice a second
+                    if settings.DEBUG and self.verbose and (finished or now - progress["printed"] >= 0.5):
+                        progress["printed"] = now
+                        rate = round(progress["fetched"] / 1024.0 / 1024 / max(now - start, 0.001), 1)
+                        sys.stdout.write("\r  * getting haus files (%s%% of %sMB %scompressed, %s of %s files) %s MB/s   " %
+                                         (int((float(progress["fetched"]) / total_size) * 100) if total_size else 100, total_size_mb,
+                                          'un' if not progress["compressed"] else '', progress["files"], len(files), rate))
+                        sys.stdout.flush()
+
+            workers = min(self.download_workers, len(files)) or 1
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                # each file is retried on its own
+                futures = [executor.submit(self.retry, functools.partial(self._download_file, token, dest_dir, f, report, multi_file, progress))
+                           for f in files]
+                try:
+                    for future in as_completed(futures):
+                        future.result()
+                except Exception:
+                    for future in futures:
+                        future.cancel()
+                    raise
+
+            fetched = progress["fetched"]
+            elapsed = time.time() - start
+            if self.verbose:
+                print("\n    Fetched %s files, %sMB in %s seconds (%s MB/s, %s at a time)" % (len(files),
+                                                                                        round(fetched / 1024.0 / 1024, 1),
+                                                                                        round(elapsed, 1),
+                                                                                        round(fetched / 1024.0 / 1024 / max(elapsed, 0.001), 1),
+                                                                                        workers))
+            if not multi_file and fetched != total_size:
+                print("  WARNING only received %s out of %s bytes." % (fetched, total_size))
 
             if unpack and 'is_stream.tar' in files:
                 tarfile = "%s/%s" % (dest_dir, 'is_stream.tar')
@@ -412,6 +414,50 @@ class Grab(object):
 
         return False
 
+    def _download_file(self, token, dest_dir, f, report, multi_file, progress):
+        """
+        Streams one file of a session to dest_dir over the pooled session, calling report with each block's size.
+        A retry starts the file over, what it had fetched is taken back first.
+        """
+        response = self.session.get(self.get_uri('/entity/'),
+                                    params={"access_token": token, 'filename': f},
+                                    headers=self.request_headers,
+                                    stream=True,
+                                    **self.ssl_args)
+        compressed = True if response.headers.get('content-encoding') == 'gzip' else False
+        progress["compressed"] = progress["compressed"] or compressed
+
+        if response.status_code != requests.codes.ok:
+            raise Exception("Unable to read session: %s" % response.text)
+
+        fetched = 0
+        actual = None
+        chunk_size = 64 * 1024
+        try:
+            with open('%s/%s' % (dest_dir, f), 'wb') as d:
+                for block in response.iter_content(chunk_size):
+                    # do this here so we don't throw it for the last chunk, which is allowed to be smaller
+                    if not multi_file and not compressed and actual is not None and actual < chunk_size:
+                        if self.verbose:
+                            print("\r  * chunk starting at %s of %s was less than expected: %s of %s" % (fetched - actual,
+                                                                                                         f,
+                                                                                                         actual,
+                                                                                                         chunk_size))
+
+                    actual = len(block)
+                    fetched += actual
+
+                    d.write(block)
+                    report(actual)
+        except Exception:
+            report(-fetched)
+            raise
+        finally:
+            response.close()
+
+        report(0, finished=True)
+        return fetched
+
     def _upload_to_s3(self, dir, client, tag):
 
         s3 = boto3.resource('s3')
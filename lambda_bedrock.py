@@ -1,18 +1,17 @@
+import hashlib
 import json
-import logging
-from datetime import datetime
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor, wait
 
 import boto3
+from botocore.config import Config
 
 # from flask import Flask, request, jsonify
 
 # app = Flask(__name__)
 
-# Initialize logging
-# logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
-logger.setLevel("INFO")
-
 # List of models to try in case of failure
 MODELS = [
     {"key":"meta","id":"meta.llama3-70b-instruct-v1:0","in_price":0.00099,"out_price":0.00099,"in_length":8*1024, "out_length":2048}
@@ -26,77 +25,185 @@ MODELS.sort(key=lambda x: x["in_price"])
 default_model = MODELS[0]["key"]
 models_dict = {model["key"]: model for model in MODELS}
 
-# Initialize the Bedrock client
-bedrock_client = boto3.client("bedrock-runtime")
+# everything below runs once per container, in the init phase, and is reused by its invocations
+
+# the requested model first, then the others from the cheapest
+model_candidates = {key: [models_dict[key]] + [model for model in MODELS if model["key"] != key] for key in models_dict}
+inference_configs = {model["key"]: {"maxTokens": model["out_length"]} for model in MODELS}
+
+headers = {'Content-Type': 'application/json'}
+
+# a batch runs up to this many items at once, a request can ask for fewer
+max_batch_concurrency = int(os.environ.get("LAMBDA_BATCH_CONCURRENCY", 8))
+max_batch_items = int(os.environ.get("LAMBDA_BATCH_MAX_ITEMS", 100))
+# seconds kept back from the Lambda timeout to return what finished
+time_margin = float(os.environ.get("LAMBDA_TIME_MARGIN", 2))
+
+# Initialize the Bedrock client, with a connection for each concurrent batch item
+bedrock_client = boto3.client("bedrock-runtime", config=Config(max_pool_connections=max_batch_concurrency))
+
+# LAMBDA_CACHE_DIR=/tmp/answers keeps answers on the container's disk for LAMBDA_CACHE_TTL seconds,
+# a repeated question on a warm container is answered without calling a model
+cache_dir = os.environ.get("LAMBDA_CACHE_DIR")
+cache_ttl = float(os.environ.get("LAMBDA_CACHE_TTL", 3600))
+if cache_dir:
+    os.makedirs(cache_dir, exist_ok=True)
+
+def cache_key(text, model_key):
+    return hashlib.sha256(f"{model_key}:{text}".encode("utf-8")).hexdigest()
+
+def cache_get(key):
+    path = os.path.join(cache_dir, key)
+    try:
+        if time.time() - os.path.getmtime(path) > cache_ttl:
+            return None
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def cache_put(key, answer):
+    path = os.path.join(cache_dir, key)
+    # renamed into place so that a concurrent reader never sees half a file
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, "w") as f:
+            json.dump(answer, f)
+        os.replace(temp_path, path)
+    except OSError as e:
+        print(f"Could not cache {key}: {e}")
+
+def answer(text, model_key, deadline=None):
+    """
+    Asks the model, then the others from the cheapest until one answers.
+    No other model is tried after deadline (time.time()).
+    Returns the text, the model id and the cost.
+    """
+    for model in model_candidates[model_key]:
+        if deadline is not None and time.time() > deadline:
+            raise Exception("Out of time")
+        try:
+            if model["in_length"] < len(text):
+                continue
+            response = bedrock_client.converse(
+                modelId=model["id"],
+                messages=[{"role": "user", "content": [{"text": text}]}],
+                inferenceConfig=inference_configs[model["key"]],
+            )
+            usage = response["usage"]
+            cost = usage["inputTokens"] / 1000.0 * model["in_price"] + usage["outputTokens"] / 1000.0 * model["out_price"]
+            response_text = response["output"]["message"]["content"][0]["text"].strip()
+            return {"text": response_text, "model": model["id"], "cost": cost}
+        except Exception as e:
+            # Log failure and try the next model
+            print(f"Model {model['id']} failed: {e}")
+
+    raise Exception("All models failed to process the request")
+
+def cached_answer(text, model_key, deadline=None):
+    """
+    answer() through the cache when LAMBDA_CACHE_DIR is set, with "cached" telling which
+    """
+    if model_key not in models_dict:
+        raise Exception(f"Unknown model {model_key}, use one of {list(models_dict)}")
+
+    key = cache_key(text, model_key) if cache_dir else None
+    result = cache_get(key) if key else None
+    if result is not None:
+        result["cost"] = 0.0
+        result["cached"] = True
+        return result
+
+    result = answer(text, model_key, deadline)
+    if key:
+        cache_put(key, result)
+    result["cached"] = False
+    return result
+
+def answer_batch(items, model_key, concurrency, deadline):
+    """
+    Answers the items ({"text", optional "model"}) concurrency at a time.
+    Items that did not finish by deadline are returned with "error": "unfinished",
+    the ones not started yet are not started.
+    """
+    start = time.time()
+
+    def answer_one(item):
+        try:
+            return cached_answer(item["text"], item.get("model", model_key), deadline)
+        except Exception as e:
+            return {"error": str(e)}
+
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    futures = [executor.submit(answer_one, item) for item in items]
+    wait(futures, timeout=max(0, deadline - time.time()))
+    # running calls finish on their own, their answers are dropped
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    results = [future.result() if future.done() and not future.cancelled() else {"error": "unfinished"} for future in futures]
+    return {
+        "results": results,
+        "cost": sum([r.get("cost", 0) for r in results]),
+        "failed": len([r for r in results if "error" in r and r["error"] != "unfinished"]),
+        "unfinished": len([r for r in results if r.get("error") == "unfinished"]),
+        "time": time.time() - start}
 
 # @app.route('/question', methods=['POST'])
 # def handle_question():
 #    return lambda_handler({"body": json.dumps(request.get_json())}, None)
 
 def lambda_handler(event, context):
+    """
+    Answers {"text", optional "model"},
+    or a batch {"batch": [{"text", optional "model"}, ...], optional "model" and "concurrency"}
+    """
 
-    start = datetime.now()
-
-    print(f"Event: {event}")
-    print(f"Context: {context}")
+    start = time.perf_counter()
 
     event_body = json.loads(event['body'])
-    request_text = event_body["text"]
     request_model = event_body.get("model", default_model)
 
     request_id = context.aws_request_id
 
-    # Log request details
-    print(f"Request {request_id} at {start}: {event_body}")
+    if "batch" in event_body:
+        return batch_handler(event_body, request_model, request_id, context, start)
 
-    model_candidates = [models_dict[request_model]] + [model for model in MODELS if model["key"] != request_model]
+    request_text = event_body["text"]
 
-    for model in model_candidates:
-        try:
-            if model["in_length"] < len(request_text):
-                continue
-            conversation = [
-                {
-                    "role": "user",
-                    "content": [
-                            {"text": request_text},
-                        ]
-                }
-            ]
-                    
-            response = bedrock_client.converse(
-                modelId=model["id"],
-                messages=conversation,
-                inferenceConfig={
-                    "maxTokens": model["out_length"],
-                    },
-            )
-            usage = response["usage"]
-            in_tokens = usage["inputTokens"]
-            out_tokens = usage["outputTokens"]
-            cost = in_tokens / 1000.0 * model["in_price"] + out_tokens / 1000.0 * model["out_price"]
-            response_text = response["output"]["message"]["content"][0]["text"].strip()
+    # the text is not logged, it can be long and private
+    print(f"Request {request_id}: {len(request_text)} characters for {request_model}")
 
-            
-            # Log successful response
-            end = datetime.now()
-            print(f"Response {request_id} at {end} with {model['id']} taking {(end-start).total_seconds()} seconds costing ${cost:f}")
-
-            # return jsonify({"text": response_text, "cost": cost}), 201
-            return {
-                "statusCode": 201,
-                "body": json.dumps(
-                    {"text": response_text, "model": model["id"], "cost": cost, "version": "0.0.1"}),
-                'headers': {
-                    'Content-Type': 'application/json',
-                }
-            }
-        except Exception as e:
-            # Log failure and try the next model
-            print(f"Model {model} failed at {datetime.now()}: {e}")
+    result = cached_answer(request_text, request_model)
 
-    # If all models fail, raise an HTTPException
-    raise Exception("All models failed to process the request")
+    print(f"Response {request_id} with {result['model']} taking {time.perf_counter() - start:f} seconds costing ${result['cost']:f}{' from cache' if result['cached'] else ''}")
+
+    # return jsonify({"text": response_text, "cost": cost}), 201
+    return {
+        "statusCode": 201,
+        "body": json.dumps({**result, "version": "0.0.3"}),
+        'headers': headers
+    }
+
+def batch_handler(event_body, request_model, request_id, context, start):
+
+    items = event_body["batch"]
+    if len(items) > max_batch_items:
+        raise Exception(f"A batch can have up to {max_batch_items} items, this one has {len(items)}")
+
+    concurrency = max(1, min(int(event_body.get("concurrency", max_batch_concurrency)), max_batch_concurrency))
+    deadline = time.time() + context.get_remaining_time_in_millis() / 1000.0 - time_margin
+
+    print(f"Request {request_id}: batch of {len(items)} for {request_model}, {concurrency} at a time")
+
+    batch = answer_batch(items, request_model, concurrency, deadline)
+
+    print(f"Response {request_id} taking {time.perf_counter() - start:f} seconds costing ${batch['cost']:f}, {batch['failed']} failed, {batch['unfinished']} unfinished")
+
+    return {
+        "statusCode": 201,
+        "body": json.dumps({**batch, "version": "0.0.3"}),
+        'headers': headers
+    }
 
 # if __name__ == "__main__":
 #    app.run(debug=True)
@@ -161,10 +161,11 @@ def search(objects):
 
   return found
       
-def bedrock_search(objects, question):
+def bedrock_search(objects, question, concurrency=8):
 
   chat = bedrock.Chat("local")
 
+  prompts = []
   for element in objects:
 
     source = element["source"]
@@ -174,6 +175,15 @@ def bedrock_search(objects, question):
 
     {source}
     """
+    prompts.append(prompt)
+
+  # each file is asked about on its own, concurrency at a time
+  batch = chat.ask_many(prompts, concurrency=concurrency)
+
+  print(f"Asked about {len(prompts)} files in {batch['time']:.1f} seconds ({batch['throughput']:.1f}/s) costing ${batch['cost']:f}, {batch['failed']} failed")
+
+  return [{"path": element["path"], "answer": result.get("text"), "error": result.get("error")}
+          for element, result in zip(objects, batch["results"])]
 
 
 directory = "/Users/daniel.nuriyev/projects/data-platform/dagster"